@@ -1,12 +1,16 @@
+import json
 import logging
 import getopt
 import sys
-from queue import Queue, Empty
+import time
+from queue import Empty
 from electron import Electron
+import gevent
 from gevent import sleep as gsleep
-from common import InternalMessage
+from common import InternalMessage, InternalMessageContent, WakeupsCounter
 from version import VERSION
 from cleepbus import CleepBus
+from messagequeue import MessageQueue
 import sentry_sdk
 from platform import platform, processor
 
@@ -15,32 +19,257 @@ logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 SENTRY_DSN = "https://47efccd983f44af9b37dd98c8d643ece@o97410.ingest.sentry.io/6704013"
 SENTRY_IGNORED_EXCEPTIONS = [KeyboardInterrupt]
 QUEUE_TIMEOUT = 10  # seconds
+BATCH_LINGER = 0.005  # seconds
+STATS_PERIOD = 60.0  # seconds
+
+# startup time used to measure time to first displayed device
+STARTED_AT = time.monotonic()
+FIRST_PEER_DISPLAYED = {"elapsed": None}
+
+# queue consumer wakeups
+QUEUE_WAKEUPS = WakeupsCounter()
+
+# queue latency stats (time between message creation and its processing)
+LATENCY_STATS = {"count": 0, "total": 0.0, "max": 0.0}
+
+
+def update_latency_stats(msg):
+    """
+    Update queue latency stats with specified message
+
+    Args:
+        msg (InternalMessage): processed message
+    """
+    latency = time.monotonic() - msg.created_at
+    LATENCY_STATS["count"] += 1
+    LATENCY_STATS["total"] += latency
+    LATENCY_STATS["max"] = max(LATENCY_STATS["max"], latency)
+
+
+def log_latency_stats():
+    """
+    Log queue latency stats
+    """
+    count = LATENCY_STATS["count"]
+    mean = (LATENCY_STATS["total"] / count) if count else 0.0
+    logger.info(
+        "Queue latency (%s mode): messages=%d mean=%.2fms max=%.2fms",
+        "greenlets" if CONFIG["greenlets"] else "polling",
+        count,
+        mean * 1000,
+        LATENCY_STATS["max"] * 1000,
+    )
+
+
+def check_first_peer_displayed(count, source):
+    """
+    Log time between startup and first device sent to electron (only once)
+
+    Args:
+        count (int): number of devices sent to electron
+        source (string): devices source (cache or bus)
+    """
+    if not count or FIRST_PEER_DISPLAYED["elapsed"] is not None:
+        return
+
+    FIRST_PEER_DISPLAYED["elapsed"] = time.monotonic() - STARTED_AT
+    logger.info(
+        "First device displayed %.3fs after startup (from %s)",
+        FIRST_PEER_DISPLAYED["elapsed"],
+        source,
+    )
+
+
+def log_wakeups_stats():
+    """
+    Log wakeups stats since startup
+    """
+    logger.info(
+        "Wakeups per second: queue=%.2f electron=%.2f bus=%.2f",
+        QUEUE_WAKEUPS.get_rate(),
+        electron.wakeups.get_rate(),
+        cleepbus.pyrebus.wakeups.get_rate(),
+    )
+
+
+def log_stats_forever():
+    """
+    Greenlet logging wakeups stats of last period, to follow idle activity while running
+    """
+    while True:
+        gsleep(CONFIG["statsperiod"])
+        logger.info(
+            "Wakeups per second (last %.0fs): queue=%.2f electron=%.2f bus=%.2f",
+            CONFIG["statsperiod"],
+            QUEUE_WAKEUPS.get_window_rate(),
+            electron.wakeups.get_window_rate(),
+            cleepbus.pyrebus.wakeups.get_window_rate(),
+        )
+
+
+def send_peers_snapshot():
+    """
+    Send snapshot of known peers to electron when websocket is (re)connected
+
+    Queued presence messages are dropped because snapshot holds current presence state,
+    only presence changes occuring after it are sent.
+    """
+    dropped = shared_queue.clear_lane(MessageQueue.LANE_PRESENCE)
+    peers = cleepbus.get_peers_snapshot()
+    logger.debug(
+        "Send snapshot of %d peers to electron (%d queued presence messages dropped)",
+        len(peers),
+        dropped,
+    )
+    electron.send_snapshot(peers)
+    cached = any(peer_infos.extra.get("cached") for peer_infos in peers)
+    check_first_peer_displayed(len(peers), "cache" if cached else "bus")
 
 
 def send_message_to_bus(message):
-    logger.info("Message received from electron: %r", message)
+    """
+    Forward message received from electron to bus
+
+    Message is pushed to bus without waiting for previous messages to be sent.
+
+    Args:
+        message (str): json encoded message or list of messages
+    """
+    logger.debug("Message received from electron: %r", message)
+    try:
+        decoded = json.loads(message)
+    except Exception:
+        logger.warning("Invalid message received from electron: %r", message)
+        return
+
+    messages = decoded if isinstance(decoded, list) else [decoded]
+    for msg, error in cleepbus.send_messages(messages):
+        logger.error("Unable to send message to bus: %r (%s)", msg, error)
+    logger.debug("Bus send stats: %s", cleepbus.get_send_stats())
+
+
+def get_queued_messages():
+    """
+    Get queued messages waiting for the first one, then draining up to configured batch size
+    during a short linger window
+
+    Returns:
+        list: list of InternalMessage (can be empty)
+    """
+    try:
+        timeout = None if CONFIG["idle"] else QUEUE_TIMEOUT
+        messages = [shared_queue.get(block=True, timeout=timeout)]
+    except Empty:
+        return []
+    finally:
+        QUEUE_WAKEUPS.hit()
+
+    deadline = time.monotonic() + BATCH_LINGER
+    while len(messages) < CONFIG["batchsize"]:
+        try:
+            messages.append(shared_queue.get_nowait())
+        except Empty:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                messages.append(shared_queue.get(block=True, timeout=remaining))
+            except Empty:
+                break
+
+    return messages
 
 
 def process_queue():
     """
     Process messages queue
 
+    Messages to electron are sent in a single websocket frame
+
     Returns:
         bool: False if application received stop order, True otherwise
     """
-    try:
-        msg = shared_queue.get(block=True, timeout=QUEUE_TIMEOUT)
-        if msg:
-            if msg.message_type == InternalMessage.MESSAGE_TYPE_FROMELECTRON:
-                if msg.content == "$$STOP$$":
-                    return False
-                send_message_to_bus(msg.content)
-            if msg.message_type == InternalMessage.MESSAGE_TYPE_TOELECTRON:
-                electron.send_message(msg.content)
-    except Empty:
-        pass
+    to_electron = []
+    running = True
+    for msg in get_queued_messages():
+        if not msg:
+            continue
+        update_latency_stats(msg)
+        if msg.message_type == InternalMessage.MESSAGE_TYPE_FROMELECTRON:
+            if msg.content == "$$STOP$$":
+                running = False
+                break
+            send_message_to_bus(msg.content)
+        if msg.message_type == InternalMessage.MESSAGE_TYPE_TOELECTRON:
+            to_electron.append(msg.content)
+            if (
+                getattr(msg.content, "content_type", None)
+                == InternalMessageContent.CONTENT_TYPE_PEER_CONNECTED
+            ):
+                check_first_peer_displayed(1, "bus")
+
+    electron.send_messages(to_electron)
 
-    return True
+    return running
+
+
+def run_polling_loop():
+    """
+    Run main loop polling websocket, bus and queue one after the other
+    """
+    while True:
+        electron.read_message()
+        cleepbus.read_messages()
+        if electron.is_connected():
+            running = process_queue()
+            if not running:
+                logger.info("Received quit command from electron")
+                break
+        else:
+            gsleep(1.0)
+
+
+def read_electron_forever():
+    """
+    Greenlet reading websocket messages as soon as they arrive
+    """
+    while True:
+        electron.read_message(wait=True)
+
+
+def read_bus_forever():
+    """
+    Greenlet reading bus messages as soon as they arrive
+    """
+    cleepbus.run(blocking=CONFIG["idle"])
+
+
+def process_queue_forever():
+    """
+    Greenlet processing queued messages as soon as they are queued
+    """
+    while True:
+        electron.wait_connected()
+        if not process_queue():
+            logger.info("Received quit command from electron")
+            break
+
+
+def run_greenlets_loop():
+    """
+    Run main loop with websocket reader, bus reader and queue consumer in their own greenlet
+    """
+    greenlets = [
+        gevent.spawn(read_bus_forever),
+        gevent.spawn(process_queue_forever),
+    ]
+    if electron.is_enabled():
+        greenlets.append(gevent.spawn(read_electron_forever))
+    try:
+        # stop as soon as one greenlet ends (quit command or error)
+        gevent.joinall(greenlets, count=1, raise_error=True)
+    finally:
+        gevent.killall(greenlets)
 
 
 def show_version():
@@ -49,25 +278,58 @@ def show_version():
 
 def show_usage():
     print(
-        "Usage: ./cleepbus [-n|--no-ws] [-u|--uuid] [-p|--ws-port] [-d|--debug] [-v|--version] [-h|--help]"
+        "Usage: ./cleepbus [-n|--no-ws] [-u|--uuid] [-p|--ws-port] [-g|--greenlets] [-i|--idle] [-b|--batch-size] [-c|--peers-cache] [-w|--presence-window] [-l|--channels] [-z|--zlib-threshold] [-s|--stats-period] [-d|--debug] [-v|--version] [-h|--help]"
     )
     print("options:")
-    print(" -n|--no-ws:   disable websocket feature")
-    print(" -u|--uuid:    specify Cleep network uuid")
-    print(" -p|--ws-port: websocket port (if not disabled)")
-    print(" -v|--version: show cleepbus version")
-    print(" -t|--test:    lauch app and stop")
-    print(" -h|--help:    this help")
+    print(" -n|--no-ws:           disable websocket feature")
+    print(" -u|--uuid:            specify Cleep network uuid")
+    print(" -p|--ws-port:         websocket port (if not disabled)")
+    print(" -g|--greenlets:       event-driven mode (websocket, bus and queue run in their own greenlet)")
+    print(" -i|--idle:            greenlets mode without periodic wakeups when idle")
+    print(" -b|--batch-size:      max number of messages sent to electron in a single frame")
+    print(" -c|--peers-cache:     peers cache file path to display known peers at startup (disabled by default)")
+    print(" -w|--presence-window: peer presence changes coalescing window in seconds (0 to disable)")
+    print(" -l|--channels:        comma separated bus channels to join, first one is default (CLEEP)")
+    print(" -z|--zlib-threshold:  bus payload size in bytes above which it is compressed (default 4096)")
+    print(" -s|--stats-period:    wakeups stats logging period in seconds (default 60, 0 to disable)")
+    print(" -v|--version:         show cleepbus version")
+    print(" -t|--test:            lauch app and stop")
+    print(" -h|--help:            this help")
 
 
 # command line arguments
-CONFIG = {"websocket": True, "uuid": None, "debug": False}
+CONFIG = {
+    "websocket": True,
+    "uuid": None,
+    "debug": False,
+    "greenlets": False,
+    "idle": False,
+    "batchsize": 1,
+    "statsperiod": STATS_PERIOD,
+    "peerscache": None,
+}
 RUN_AND_STOP = False
 try:
     opts, args = getopt.getopt(
         sys.argv[1:],
-        "nu:vdp:ht",
-        ["debug", "no-ws", "uuid=", "version", "ws-port=", "help", "test"],
+        "nu:vdp:htgib:c:w:l:z:s:",
+        [
+            "debug",
+            "no-ws",
+            "uuid=",
+            "version",
+            "ws-port=",
+            "help",
+            "test",
+            "greenlets",
+            "idle",
+            "batch-size=",
+            "peers-cache=",
+            "presence-window=",
+            "channels=",
+            "zlib-threshold=",
+            "stats-period=",
+        ],
     )
 except Exception:
     logging.exception("Invalid command arguments")
@@ -83,6 +345,25 @@ for opt, arg in opts:
     if opt in ("-d", "--debug"):
         CONFIG["debug"] = True
         logging.basicConfig(level=logging.INFO)
+    if opt in ("-g", "--greenlets"):
+        CONFIG["greenlets"] = True
+    if opt in ("-i", "--idle"):
+        CONFIG["greenlets"] = True
+        CONFIG["idle"] = True
+    if opt in ("-b", "--batch-size"):
+        CONFIG["batchsize"] = max(1, int(arg))
+    if opt in ("-c", "--peers-cache"):
+        CONFIG["peerscache"] = arg or None
+    if opt in ("-w", "--presence-window"):
+        CONFIG["presencewindow"] = max(0.0, float(arg))
+    if opt in ("-l", "--channels"):
+        CONFIG["channels"] = [
+            channel.strip() for channel in arg.split(",") if channel.strip()
+        ] or None
+    if opt in ("-z", "--zlib-threshold"):
+        CONFIG["compressionthreshold"] = max(1, int(arg))
+    if opt in ("-s", "--stats-period"):
+        CONFIG["statsperiod"] = max(0.0, float(arg))
     if opt in ("-t", "--test"):
         RUN_AND_STOP = True
     if opt in ("-v", "--version"):
@@ -109,25 +390,22 @@ else:
 
 logger.info("========== cleep-desktop-cleepbus v%s started ==========", VERSION)
 exit_code = 0
+stats_logger = None
 try:
-    shared_queue = Queue(maxsize=100)
+    shared_queue = MessageQueue()
     cleepbus = CleepBus(shared_queue, CONFIG)
     cleepbus.start()
     electron = Electron(shared_queue, CONFIG)
+    electron.set_on_connected(send_peers_snapshot)
+    if CONFIG["statsperiod"]:
+        stats_logger = gevent.spawn(log_stats_forever)
 
     if RUN_AND_STOP:
         gsleep(10.0)
+    elif CONFIG["greenlets"]:
+        run_greenlets_loop()
     else:
-        while True:
-            electron.read_message()
-            cleepbus.read_messages()
-            if electron.is_connected():
-                running = process_queue()
-                if not running:
-                    logger.info("Received quit command from electron")
-                    break
-            else:
-                gsleep(1.0)
+        run_polling_loop()
 
 except KeyboardInterrupt:
     pass
@@ -138,11 +416,20 @@ except Exception as error:
         sentry_sdk.capture_exception(error)
     exit_code = 1
 
+if stats_logger:
+    stats_logger.kill()
 try:
     cleepbus.stop()
     electron.stop()
 except Exception:
     pass
 
+log_latency_stats()
+try:
+    log_wakeups_stats()
+    logger.info("Queue stats: %s", shared_queue.get_stats())
+    logger.info("Bus send stats: %s", cleepbus.get_send_stats())
+except Exception:
+    pass
 logger.info("cleep-desktop-cleepbus stopped")
 sys.exit(exit_code)
@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cleepbus micro benchmarks
+
+Usage: python benchmark.py [benchmark name ...] (all benchmarks if not specified)
+"""
+
+import copy
+import json
+import sys
+import time
+import tracemalloc
+import uuid
+from queue import Empty
+import gevent
+import zmq.green as zmq
+from gevent.queue import Queue
+from cleepbus import CleepBus
+from codec import JsonCodec
+from common import (
+    InternalMessage,
+    InternalMessageContent,
+    LruCache,
+    MessageRequest,
+    MessageResponse,
+    PeerInfos,
+    str2bool,
+)
+from externalbus import ExternalBus
+from messagequeue import MessageQueue
+from pyrebus import PyreBus
+
+WEBSOCKET_TIMEOUT = 0.25  # seconds, websocket read timeout of polling loop
+QUEUE_TIMEOUT = 10  # seconds, queue read timeout of polling loop
+
+
+def build_peer_headers(index):
+    """
+    Build headers of a fake cleep device
+
+    Args:
+        index (int): device index
+
+    Returns:
+        dict: device headers as received on ENTER
+    """
+    return {
+        "uuid": str(uuid.uuid4()),
+        "version": "0.1.0",
+        "hostname": f"cleep{index}",
+        "port": "80",
+        "macs": json.dumps([f"b8:27:eb:00:{index // 256:02x}:{index % 256:02x}"]),
+        "ssl": "0",
+        "auth": "0",
+        "cleepdesktop": "0",
+        "apps": "audio,network,system,parameters,update",
+        "hwmodel": json.dumps({"model": "3B+", "revision": "a020d3"}),
+        "codecs": json.dumps(["msgpack", "json"]),
+        "compression": "zlib",
+        "batch": "1",
+    }
+
+
+def bench_enter_storm(peers=500, rounds=20):
+    """
+    Decode headers of peers reconnecting several times (ENTER storm), with previous decoding
+    (no cache) and with peer headers cache
+
+    Args:
+        peers (int): number of peers
+        rounds (int): number of times each peer reconnects
+    """
+    cleepbus = CleepBus(MessageQueue(), {})
+    decode_peer_infos = cleepbus.pyrebus.decode_peer_infos
+    headers = [build_peer_headers(index) for index in range(peers)]
+    enters = peers * rounds
+
+    def decode_peer_infos_uncached(infos):
+        # previous CleepBus decoding, without cache
+        peer_infos = PeerInfos()
+        peer_infos.uuid = infos.get("uuid", None)
+        peer_infos.hostname = infos.get("hostname", None)
+        peer_infos.port = int(infos.get("port", peer_infos.port))
+        peer_infos.ssl = bool(str2bool(infos.get("ssl", f"{peer_infos.ssl}")))
+        peer_infos.auth = bool(str2bool(infos.get("auth", f"{peer_infos.auth}")))
+        peer_infos.cleepdesktop = bool(
+            str2bool(infos.get("cleepdesktop", f"{peer_infos.cleepdesktop}"))
+        )
+        peer_infos.macs = json.loads(infos.get("macs", "[]"))
+        peer_infos.extra = {
+            key: CleepBus.decode_header_value(key, value)
+            for key, value in infos.items()
+            if key not in ["uuid", "hostname", "port", "ssl", "cleepdesktop", "macs"]
+        }
+        return peer_infos
+
+    # without cache
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for infos in headers:
+            decode_peer_infos_uncached(infos)
+    uncached = time.perf_counter() - start
+
+    # with cache
+    cleepbus.peer_headers_cache = LruCache(CleepBus.PEER_HEADERS_CACHE_SIZE)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for infos in headers:
+            decode_peer_infos(infos)
+    cached = time.perf_counter() - start
+
+    print(f"ENTER storm: {peers} peers x {rounds} reconnections")
+    print(f"  uncached: {uncached * 1e6 / enters:.2f}us/enter")
+    print(f"  cached:   {cached * 1e6 / enters:.2f}us/enter")
+    print(f"  cache:    {cleepbus.peer_headers_cache.to_dict()}")
+
+
+def bench_memory(peers=500, messages=10000):
+    """
+    Measure memory and allocations of peers and of messages in flight to electron
+
+    Args:
+        peers (int): number of peers
+        messages (int): number of messages in flight
+    """
+    cleepbus = CleepBus(MessageQueue(), {})
+    decode_peer_infos = cleepbus.pyrebus.decode_peer_infos
+    headers = [build_peer_headers(index) for index in range(peers)]
+
+    tracemalloc.start()
+    start_size, _ = tracemalloc.get_traced_memory()
+    registry = []
+    for index, infos in enumerate(headers):
+        peer_infos = decode_peer_infos(infos)
+        peer_infos.ident = str(uuid.uuid4())
+        peer_infos.ip = f"192.168.{index // 256}.{index % 256}"
+        registry.append(peer_infos)
+    peers_size, _ = tracemalloc.get_traced_memory()
+
+    in_flight = []
+    for index in range(messages):
+        request = MessageRequest()
+        request.fill_from_dict(
+            {
+                "event": "system.device.heartbeat",
+                "params": {"uptime": index},
+                "peer_infos": registry[index % peers].to_dict(),
+            }
+        )
+        content = InternalMessageContent(
+            content_type=InternalMessageContent.CONTENT_TYPE_MESSAGE_RESPONSE,
+            peer_infos=registry[index % peers],
+            data=request,
+        )
+        in_flight.append(
+            InternalMessage(
+                message_type=InternalMessage.MESSAGE_TYPE_TOELECTRON,
+                content=content,
+            )
+        )
+    messages_size, peak_size = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocations = sum(stat.count for stat in snapshot.statistics("filename"))
+
+    print(f"Memory: {peers} peers, {messages} messages in flight")
+    print(f"  per peer:    {(peers_size - start_size) / peers:.0f} bytes")
+    print(f"  per message: {(messages_size - peers_size) / messages:.0f} bytes")
+    print(f"  peak:        {peak_size - start_size} bytes")
+    print(f"  live blocks: {allocations}")
+
+
+def bench_params_copy(messages=1000, rounds=5):
+    """
+    Fill messages with large nested params, deep copying them and with ownership transfer or
+    copy on write (params frozen on each fill or already frozen). Check copy on write params
+    mutations do not leak between messages
+
+    Args:
+        messages (int): number of messages
+        rounds (int): number of runs (best one is kept)
+    """
+    params = {
+        "config": {
+            f"module{module}": {
+                "enabled": True,
+                "values": list(range(50)),
+                "options": {f"option{option}": f"value{option}" for option in range(20)},
+            }
+            for module in range(20)
+        }
+    }
+    payload = json.dumps(
+        {"command": "get_modules_configs", "to": "inventory", "params": params}
+    )
+    decoded = [json.loads(payload) for _ in range(messages)]
+
+    def run(fill):
+        durations = []
+        for _ in range(rounds):
+            sources = [copy.copy(message) for message in decoded]
+            start = time.perf_counter()
+            for source in sources:
+                fill(source)
+            durations.append(time.perf_counter() - start)
+        return min(durations) * 1e6 / messages
+
+    def fill_from_dict(owned):
+        return lambda source: MessageRequest().fill_from_dict(source, owned)
+
+    source_params = decoded[0]["params"]
+    source_request = MessageRequest()
+    source_request.fill_from_dict(decoded[0], owned=True)
+
+    frozen_request = MessageRequest()
+    frozen_request.fill_from_request(source_request)
+
+    def freeze_request(_):
+        MessageRequest().fill_from_request(source_request)
+
+    def share_request(_):
+        MessageRequest().fill_from_request(frozen_request)
+
+    def deepcopy_request(_):
+        # previous fill_from_request behavior
+        copy.deepcopy(source_params)
+        MessageRequest().fill_from_request(frozen_request)
+
+    print(f"Params copy: {len(payload)} bytes params, {messages} messages")
+    print(f"  fill_from_dict copy:     {run(fill_from_dict(False)):.2f}us/message")
+    print(f"  fill_from_dict owned:    {run(fill_from_dict(True)):.2f}us/message")
+    print(f"  fill_from_request copy:  {run(deepcopy_request):.2f}us/message")
+    print(f"  fill_from_request freeze:{run(freeze_request):.2f}us/message")
+    print(f"  fill_from_request frozen:{run(share_request):.2f}us/message")
+
+    # frozen params are deeply read-only
+    shared_request = MessageRequest()
+    shared_request.fill_from_request(source_request)
+    for write in (
+        lambda params: params.update(config=None),
+        lambda params: params["config"]["module0"].update(enabled=False),
+        lambda params: params["config"]["module0"]["options"].pop("option0"),
+    ):
+        try:
+            write(shared_request.params)
+            raise AssertionError("Frozen params are writable")
+        except (TypeError, AttributeError):
+            pass
+    try:
+        shared_request.params["config"]["module0"]["values"].append(-1)
+        raise AssertionError("Frozen params are writable")
+    except AttributeError:
+        pass
+
+    # mutable copy does not leak to source message nor to other copies
+    other_request = MessageRequest()
+    other_request.fill_from_request(shared_request)
+    shared_request.get_mutable_params()["config"]["module0"]["enabled"] = False
+    shared_request.get_mutable_params()["config"]["module0"]["values"].append(-1)
+    for params in (source_request.params, other_request.params):
+        module = params["config"]["module0"]
+        if module["enabled"] is not True or module["values"][-1] == -1:
+            raise AssertionError("Params mutation leaked to other message")
+
+    # source message stays writable and its mutations do not leak to copy
+    source_request.params["config"]["module0"]["enabled"] = False
+    source_request.params["config"]["module0"]["values"].append(-2)
+    module = other_request.params["config"]["module0"]
+    if module["enabled"] is not True or module["values"][-1] == -2:
+        raise AssertionError("Source params mutation leaked to copy")
+    print("  copy on write:           no leak between messages")
+
+
+def bench_electron_frames(peers=50, messages=100, rounds=200):
+    """
+    Build electron batch frames serializing messages from dicts and joining cached peer infos
+    json
+
+    Args:
+        peers (int): number of peers
+        messages (int): number of messages per frame
+        rounds (int): number of frames
+    """
+    cleepbus = CleepBus(MessageQueue(), {})
+    decode_peer_infos = cleepbus.pyrebus.decode_peer_infos
+    registry = [decode_peer_infos(build_peer_headers(index)) for index in range(peers)]
+    contents = [
+        InternalMessageContent(
+            content_type=InternalMessageContent.CONTENT_TYPE_MESSAGE_RESPONSE,
+            peer_infos=registry[index % peers],
+            data=MessageRequest(event="system.device.heartbeat", params={"uptime": index}),
+        )
+        for index in range(messages)
+    ]
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        frame = json.dumps({"batch": True, "messages": [content.to_dict() for content in contents]})
+    from_dicts = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        frame = '{"batch": true, "messages": [' + ", ".join(
+            content.to_json() for content in contents
+        ) + "]}"
+    from_cache = time.perf_counter() - start
+
+    print(f"Electron frames: {messages} messages from {peers} peers per frame ({len(frame)} bytes)")
+    print(f"  from dicts:       {from_dicts * 1e6 / rounds:.0f}us/frame")
+    print(f"  from cached json: {from_cache * 1e6 / rounds:.0f}us/frame")
+
+
+def bench_send_path(messages=10000):
+    """
+    Send commands to a peer through the previous send path (message json encoded on pipe,
+    decoded, copied and encoded again on bus side) and through the single serialization path
+    (cleaned message encoded once), measuring CPU time and allocations peak per message
+
+    Args:
+        messages (int): number of messages
+    """
+    codec = JsonCodec()
+    peer_infos = PeerInfos(
+        uuid=str(uuid.uuid4()),
+        ident=str(uuid.uuid4()),
+        hostname="cleep0",
+        macs=["b8:27:eb:00:00:00"],
+    )
+    requests = []
+    for index in range(messages):
+        request = MessageRequest(
+            command="set_config",
+            params={"index": index, "values": list(range(20)), "enabled": True},
+            to="system",
+        )
+        request.peer_infos = peer_infos
+        request.command_uuid = str(uuid.uuid4())
+        request.timeout = 5.0
+        requests.append(request)
+
+    def before(request):
+        # previous behavior: json on pipe, decoded and copied before bus encoding
+        data = json.dumps(request.to_dict()).encode()
+        message = MessageRequest()
+        message.fill_from_dict(json.loads(data))
+        return json.dumps(PyreBus.clean_message(message)).encode()
+
+    def after(request):
+        return codec.encode(PyreBus.clean_message(request))
+
+    print(f"Send path: {messages} commands")
+    for name, send in (("json on pipe", before), ("single encode", after)):
+        start = time.process_time()
+        for request in requests:
+            send(request)
+        cpu = time.process_time() - start
+
+        tracemalloc.start()
+        start_size, _ = tracemalloc.get_traced_memory()
+        send(requests[0])
+        _, peak_size = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(
+            f"  {name + ':':15} {cpu * 1e6 / messages:.2f}us/message cpu, "
+            f"{peak_size - start_size} bytes allocations peak/message"
+        )
+
+
+def bench_loop_latency(messages=20, interval=0.1, batch_size=1):
+    """
+    Measure latency between bus frame arrival and its processing by queue consumer, with
+    polling main loop and with greenlets
+
+    Bus frames go through a zmq inproc pipe polled like PyreBus does and messages through the
+    message queue. Idle websocket read of polling loop is its read timeout.
+
+    Args:
+        messages (int): number of bus frames
+        interval (float): time between bus frames in seconds
+        batch_size (int): max number of messages processed per queue read
+    """
+    context = zmq.Context()
+
+    def run(loop):
+        endpoint = f"inproc://latency-{loop.__name__}"
+        sender = context.socket(zmq.PAIR)
+        sender.bind(endpoint)
+        receiver = context.socket(zmq.PAIR)
+        receiver.connect(endpoint)
+        poller = zmq.Poller()
+        poller.register(receiver, zmq.POLLIN)
+        queue = MessageQueue()
+        latencies = []
+
+        def produce():
+            for _ in range(messages):
+                sender.send(json.dumps(time.monotonic()).encode())
+                gevent.sleep(interval)
+
+        def read_bus(timeout):
+            if not poller.poll(timeout):
+                return
+            while PyreBus.has_pending_frame(receiver):
+                request = MessageRequest(
+                    event="bench.latency", params={"sentat": json.loads(receiver.recv())}
+                )
+                content = InternalMessageContent(
+                    content_type=InternalMessageContent.CONTENT_TYPE_MESSAGE_RESPONSE,
+                    peer_infos=None,
+                    data=request,
+                )
+                queue.put(
+                    InternalMessage(
+                        message_type=InternalMessage.MESSAGE_TYPE_TOELECTRON,
+                        content=content,
+                    )
+                )
+
+        def process_queue(timeout):
+            try:
+                queued = [queue.get(block=True, timeout=timeout)]
+                while len(queued) < batch_size and not queue.empty():
+                    queued.append(queue.get_nowait())
+            except Empty:
+                pass
+            else:
+                now = time.monotonic()
+                latencies.extend(now - msg.content.data.params["sentat"] for msg in queued)
+
+        producer = gevent.spawn(produce)
+        loop(read_bus, process_queue, lambda: producer.dead and queue.empty())
+        sender.close()
+        receiver.close()
+        return sorted(latencies)
+
+    def polling(read_bus, process_queue, done):
+        # same sequence as app run_polling_loop
+        while not done():
+            gevent.sleep(WEBSOCKET_TIMEOUT)
+            read_bus(PyreBus.POLL_TIMEOUT)
+            process_queue(QUEUE_TIMEOUT)
+
+    def greenlets(read_bus, process_queue, done):
+        # same greenlets as app run_greenlets_loop
+        def read_bus_forever():
+            while True:
+                read_bus(None)
+
+        reader = gevent.spawn(read_bus_forever)
+        while not done():
+            process_queue(1.0)
+        reader.kill()
+
+    print(
+        f"Loop latency: {messages} bus frames every {interval * 1000:.0f}ms, "
+        f"batch size {batch_size}"
+    )
+    for loop in (polling, greenlets):
+        latencies = run(loop)
+        count = len(latencies)
+        mean = sum(latencies) / count if count else 0.0
+        p99 = latencies[int(count * 0.99) - 1] if count else 0.0
+        print(
+            f"  {loop.__name__ + ':':10} mean={mean * 1000:.2f}ms p99={p99 * 1000:.2f}ms "
+            f"max={(latencies[-1] if count else 0.0) * 1000:.2f}ms "
+            f"dropped={messages - count}"
+        )
+    context.term()
+
+
+class LoopbackBus(ExternalBus):
+    """
+    External bus answering its own commands: sent messages are queued and processed by
+    run_once as if peers responded them
+    """
+
+    def __init__(self):
+        ExternalBus.__init__(self, None, None, None, False, None)
+        self.__messages = Queue()
+
+    def is_running(self):
+        return True
+
+    def _send_message(self, message):
+        self.__messages.put(message)
+
+    def _run_once(self, budget, blocking):
+        try:
+            message = self.__messages.get(timeout=0.05)
+        except Empty:
+            message = None
+        if message:
+            response = MessageRequest()
+            response.event = ExternalBus.COMMAND_RESPONSE_EVENT
+            response.params = MessageResponse(data=message.peer_infos.ident).to_dict()
+            response.command_uuid = message.command_uuid
+            self.on_message_received(message.peer_infos.ident, response)
+        self.expire_pending_commands()
+        return 1 if message else 0
+
+
+def bench_gather(peers=50, rounds=20):
+    """
+    Gather command responses from a separate greenlet while bus is processed, by main loop
+    calling run_once (polling mode) and by bus loop greenlet, checking no response is missing
+
+    Args:
+        peers (int): number of peers a command is gathered from
+        rounds (int): number of gathered commands
+    """
+    peer_idents = [str(uuid.uuid4()) for _ in range(peers)]
+
+    def gather(bus):
+        responses = {}
+        for _ in range(rounds):
+            message = MessageRequest(command="get_config", to="system")
+            responses = bus.gather_commands(message, peer_idents, timeout=1.0, run_bus=False)
+            missing = [ident for ident in peer_idents if ident not in responses]
+            errors = [ident for ident, response in responses.items() if response.error]
+            if missing or errors:
+                raise AssertionError(
+                    f"{len(missing)} missing and {len(errors)} error responses"
+                )
+        return len(responses)
+
+    def polling(bus, gatherer):
+        # same as app run_polling_loop: main loop calls run_once
+        while not gatherer.dead:
+            bus.run_once()
+
+    def loop(bus, gatherer):
+        # same as PyreBus run: bus processed by its own greenlet
+        def run():
+            bus._loop_greenlet = gevent.getcurrent()
+            while True:
+                bus.run_once()
+
+        reader = gevent.spawn(run)
+        gatherer.join()
+        reader.kill()
+
+    print(f"Gather: {rounds} commands to {peers} peers from separate greenlet")
+    for mode in (polling, loop):
+        bus = LoopbackBus()
+        start = time.perf_counter()
+        gatherer = gevent.spawn(gather, bus)
+        mode(bus, gatherer)
+        elapsed = time.perf_counter() - start
+        print(
+            f"  {mode.__name__ + ':':9} {gatherer.get()} responses/command, "
+            f"{elapsed * 1000 / rounds:.2f}ms/command"
+        )
+
+
+BENCHMARKS = {
+    "enterstorm": bench_enter_storm,
+    "memory": bench_memory,
+    "paramscopy": bench_params_copy,
+    "electronframes": bench_electron_frames,
+    "sendpath": bench_send_path,
+    "looplatency": bench_loop_latency,
+    "gather": bench_gather,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or list(BENCHMARKS.keys()):
+        BENCHMARKS[name]()
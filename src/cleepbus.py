@@ -1,14 +1,22 @@
 import json
+import os
 import time
 import logging
 import platform
 import uuid
+import gevent
 from pyrebus import PyreBus
+from networkwatcher import NetworkWatcher
+from peerregistry import PeerRegistry
+from presence import PresenceDebouncer
 from common import (
     InternalMessageContent,
     MessageRequest,
+    MessageResponse,
     PeerInfos,
     InternalMessage,
+    LruCache,
+    freeze_value,
     str2bool,
 )
 from version import VERSION
@@ -20,6 +28,8 @@ class CleepBus:
     """
 
     UNCONFIGURED_DEVICE_HOSTNAME = "cleepdevice"
+    PEERS_CACHE_SAVE_DELAY = 30.0  # seconds
+    PEER_HEADERS_CACHE_SIZE = 1024
 
     def __init__(self, message_queue, config):
         """
@@ -33,7 +43,17 @@ class CleepBus:
             self.logger.setLevel(logging.DEBUG)
         self.message_queue = message_queue
         self.uuid = config.get("uuid") or str(uuid.uuid4())
-        self.peers = {}
+        self.channels = config.get("channels") or ["CLEEP"]
+        self.peers = PeerRegistry(config.get("peersttl"))
+        self.peers_cache = config.get("peerscache")
+        self.__peers_cache_saved_at = 0.0
+        self.__peers_cache_dirty = False
+        self.__peers_cache_saver = None
+        self.presence = PresenceDebouncer(
+            self.__on_presence_changed, config.get("presencewindow")
+        )
+        # decoded peer headers templates by raw headers
+        self.peer_headers_cache = LruCache(self.PEER_HEADERS_CACHE_SIZE)
 
         self.pyrebus = PyreBus(
             self.__on_message_received,
@@ -42,38 +62,390 @@ class CleepBus:
             self.__decode_peer_infos,
             debug,
             None,
+            config.get("compressionthreshold"),
+        )
+        # messages received on other channels than default one are flagged with their channel
+        for channel in self.channels[1:]:
+            self.pyrebus.set_channel_callback(
+                channel, self.__get_channel_message_callback(channel)
+            )
+        self.network_watcher = NetworkWatcher(
+            self.pyrebus.get_interfaces_signature,
+            self.__on_network_changed,
+            debug,
         )
+        # interfaces signature when bus headers were built
+        self.__signature = None
 
     def start(self):
         """
         Start bus
         """
+        self.load_peers_cache()
         infos = self.get_cleepbus_headers()
-        self.pyrebus.start(infos)
+        if not self.pyrebus.start(infos, bus_channel=self.channels):
+            self.logger.warning(
+                "No usable network, bus bound to localhost until network is available"
+            )
+        self.network_watcher.start()
 
     def stop(self):
         """
         Stop bus
         """
+        self.network_watcher.stop()
         if self.pyrebus:
             self.pyrebus.stop()
+        if self.__peers_cache_saver:
+            self.__peers_cache_saver.kill()
+            self.__peers_cache_saver = None
+        if self.__peers_cache_dirty:
+            self.save_peers_cache()
+
+    def load_peers_cache(self):
+        """
+        Load known peers from peers cache file (if configured) to know them before they connect
+        """
+        if not self.peers_cache or not os.path.exists(self.peers_cache):
+            return
+
+        start = time.perf_counter()
+        try:
+            loaded = self.peers.load(self.peers_cache)
+            self.logger.info(
+                "%d peers loaded from cache in %.3fs",
+                loaded,
+                time.perf_counter() - start,
+            )
+        except Exception:
+            self.logger.exception('Unable to load peers cache "%s"', self.peers_cache)
+
+    def save_peers_cache(self):
+        """
+        Save known peers to peers cache file (if configured)
+        """
+        if not self.peers_cache:
+            return
+
+        try:
+            self.peers.save(self.peers_cache)
+            self.__peers_cache_dirty = False
+        except Exception:
+            self.logger.exception('Unable to save peers cache "%s"', self.peers_cache)
+        self.__peers_cache_saved_at = time.monotonic()
+
+    def __peers_changed(self):
+        """
+        Peers registry changed, schedule peers cache saving in a separate greenlet (not in bus
+        callback), at most once every PEERS_CACHE_SAVE_DELAY seconds
+        """
+        self.__peers_cache_dirty = True
+        if self.__peers_cache_saver or not self.peers_cache:
+            return
+
+        delay = max(
+            self.__peers_cache_saved_at + self.PEERS_CACHE_SAVE_DELAY - time.monotonic(),
+            0.0,
+        )
+        self.__peers_cache_saver = gevent.spawn_later(delay, self.__save_peers_cache_later)
+
+    def __save_peers_cache_later(self):
+        """
+        Save peers cache scheduled by __peers_changed
+        """
+        self.__peers_cache_saver = None
+        if self.__peers_cache_dirty:
+            self.save_peers_cache()
+
+    def __on_network_changed(self):
+        """
+        Network interfaces changed, restart bus node if interfaces (names, state, mac and ip
+        addresses) changed since bus headers were built, or if usable network appeared or
+        disappeared
+        """
+        signature = self.pyrebus.get_interfaces_signature()
+        macs = self.pyrebus.get_mac_addresses()
+        on_localhost = self.pyrebus.is_on_localhost()
+        if signature == self.__signature and bool(macs) != on_localhost:
+            self.logger.debug("Network changed but bus node is still valid")
+            return
+
+        self.logger.info(
+            "Network changed (usable network %s), restart bus node",
+            "available" if macs else "lost",
+        )
+        self.pyrebus.restart(self.get_cleepbus_headers())
+
+    def run(self, blocking=False):
+        """
+        Read messages from bus until bus is stopped (blocking)
+
+        Args:
+            blocking (bool): idle mode, wait for bus events without periodic timeout
+        """
+        self.pyrebus.run(blocking=blocking)
 
     def read_messages(self):
         """
-        Read message from bus and returns
+        Read messages from bus and returns
+
+        Returns:
+            int: number of handled frames
+        """
+        return self.pyrebus.run_once()
+
+    def get_peers_snapshot(self):
+        """
+        Return all known peers (online and offline)
+
+        Returns:
+            list: list of PeerInfos
         """
-        self.pyrebus.run_once()
+        return self.peers.values()
 
-    def send_message(self, message):
+    def send_message(self, message, owned=False):
         """
         Send message to bus
 
+        Message is pushed to bus without waiting for it to be sent. Command response is
+        queued to electron when received.
+
+        Event is sent once to several peers if message holds "peer_idents" list. Command is sent
+        to each of them and their responses are queued to electron in a single response.
+
         Args:
             message (dict): message data to send
+            owned (bool): message ownership is transferred (message params are not copied)
         """
         msg = MessageRequest()
-        msg.fill_from_dict(message)
-        self.pyrebus.send_message(msg)
+        msg.fill_from_dict(message, owned)
+        self.__send_request(msg, message.get("peer_idents"))
+
+    def __send_request(self, msg, peer_idents=None):
+        """
+        Send message request to bus
+
+        Args:
+            msg (MessageRequest): message request to send
+            peer_idents (list): list of peers to send message to (None to send it as usual)
+        """
+        if peer_idents and not msg.is_command():
+            self.pyrebus.multicast_message(msg, peer_idents)
+        elif peer_idents:
+            # bus is driven by app loop, wait for responses in a separate greenlet
+            gevent.spawn(self.__gather_command, msg, peer_idents)
+        elif msg.is_command():
+            self.pyrebus.send_message(
+                msg,
+                timeout=msg.timeout,
+                manual_response=self.__get_command_response_callback(msg),
+            )
+        else:
+            self.pyrebus.send_message(msg)
+
+    def send_messages(self, messages):
+        """
+        Send several messages to bus, in order
+
+        Consecutive commands to the same peer are sent together (in a single batch envelope if
+        peer supports it, each command keeping its own timeout), other messages are sent one by
+        one.
+
+        Args:
+            messages (list): list of message data to send. Messages ownership is transferred
+                             (freshly decoded messages), their params are not copied
+
+        Returns:
+            list: list of (message, error) for messages that could not be sent
+        """
+        failed = []
+        commands = []
+        commands_peer = None
+        for message in messages:
+            try:
+                msg = MessageRequest()
+                msg.fill_from_dict(message, owned=True)
+            except Exception as error:
+                failed.append((message, error))
+                continue
+
+            peer = None
+            if msg.is_command() and msg.peer_infos and not message.get("peer_idents"):
+                peer = msg.peer_infos.uuid or msg.peer_infos.ident
+            if peer and peer == commands_peer:
+                commands.append(msg)
+                continue
+
+            # send pending commands before this message to keep messages order
+            failed.extend(self.__send_commands(commands))
+            commands = []
+            commands_peer = peer
+            if peer:
+                commands.append(msg)
+                continue
+            try:
+                self.__send_request(msg, message.get("peer_idents"))
+            except Exception as error:
+                failed.append((message, error))
+
+        failed.extend(self.__send_commands(commands))
+        return failed
+
+    def __send_commands(self, commands):
+        """
+        Send commands to the same peer together
+
+        Args:
+            commands (list): list of command MessageRequest (can be empty)
+
+        Returns:
+            list: list of (message, error) for commands that could not be sent
+        """
+        if not commands:
+            return []
+
+        try:
+            self.pyrebus.send_commands(
+                commands,
+                timeout=None,
+                manual_responses=[
+                    self.__get_command_response_callback(msg) for msg in commands
+                ],
+            )
+        except Exception as error:
+            return [(msg.to_dict(), error) for msg in commands]
+        return []
+
+    def __gather_command(self, msg, peer_idents):
+        """
+        Send command to several peers and queue all their responses to electron at once, when
+        all peers responded or command timed out
+
+        Response data holds each peer response by peer ident (timeout error response for
+        peers that did not respond)
+
+        Args:
+            msg (MessageRequest): command to send
+            peer_idents (list): list of peer identifiers
+        """
+        command_uuid = msg.command_uuid
+        try:
+            responses = self.pyrebus.gather_commands(
+                msg, peer_idents, timeout=msg.timeout, run_bus=False
+            )
+        except Exception:
+            self.logger.exception("Unable to send command %s to peers", msg)
+            responses = {}
+
+        data = {
+            peer_ident: (
+                responses.get(peer_ident)
+                or MessageResponse(error=True, message="Command timeout")
+            ).to_dict()
+            for peer_ident in peer_idents
+        }
+        content = InternalMessageContent(
+            content_type=InternalMessageContent.CONTENT_TYPE_MESSAGE_RESPONSE,
+            peer_infos=None,
+            data=MessageResponse(
+                error=any(response["error"] for response in data.values()),
+                data=data,
+            ),
+            command_uuid=command_uuid,
+        )
+        msg = InternalMessage(
+            message_type=InternalMessage.MESSAGE_TYPE_TOELECTRON,
+            content=content,
+        )
+        self.message_queue.put(msg)
+
+    def __get_command_response_callback(self, request):
+        """
+        Return callback queuing response of specified command
+
+        Command uuid set by electron (if any) is kept to be echoed in response, bus replaces it
+        by its own one when sending command.
+
+        Args:
+            request (MessageRequest): command to send
+
+        Returns:
+            function: command response callback
+        """
+        command_uuid = request.command_uuid
+        return lambda response: self.__on_command_response(
+            request, response, command_uuid or request.command_uuid
+        )
+
+    def get_send_stats(self):
+        """
+        Return messages sending stats
+
+        Returns:
+            dict: sending stats::
+
+            {
+                pushed (int): number of messages pushed to bus
+                sent (int): number of messages sent on bus
+                inflight (int): number of messages pushed to bus and not sent yet
+                backlog (int): number of messages waiting for bus pipe room
+                pendingcommands (int): number of commands waiting for response
+                expiredcommands (int): number of commands expired without response
+                compression (dict): compression stats (see Codecs.get_compression_stats)
+                reconnection (dict): node restarts stats (see PyreBus.get_reconnection_stats)
+                channels (dict): messages and bytes by channel (see PyreBus.get_channel_stats)
+                peers (dict): peers registry stats (see PeerRegistry.get_stats)
+                routes (int): number of entries in bus routing table
+                headerscache (dict): peer headers decoding cache stats (see LruCache.to_dict)
+                presence (dict): presence debouncing stats (see PresenceDebouncer.get_stats)
+            }
+
+        """
+        stats = self.pyrebus.get_pipe_stats()
+        stats["pendingcommands"] = self.pyrebus.get_pending_commands_count()
+        stats["expiredcommands"] = self.pyrebus.get_expired_commands_count()
+        stats["compression"] = self.pyrebus.codecs.get_compression_stats()
+        stats["reconnection"] = self.pyrebus.get_reconnection_stats()
+        stats["channels"] = self.pyrebus.get_channel_stats()
+        stats["peers"] = self.peers.get_stats()
+        stats["routes"] = self.pyrebus.get_routes_count()
+        stats["headerscache"] = self.peer_headers_cache.to_dict()
+        stats["presence"] = self.presence.get_stats()
+        return stats
+
+    def __on_command_response(self, request, response, command_uuid):
+        """
+        Handle response of command sent to bus
+
+        Args:
+            request (MessageRequest): sent command
+            response (MessageResponse): command response
+            command_uuid (string): command uuid echoed to electron
+        """
+        peer_infos = request.peer_infos
+        if peer_infos:
+            # peer may have reconnected with a new ident, find it by its device uuid
+            peer_infos = (
+                self.peers.find_by_uuid(peer_infos.uuid)
+                or self.peers.get(peer_infos.ident)
+                or peer_infos
+            )
+        self.logger.debug(
+            "Command response received from %s: %s",
+            peer_infos.ident if peer_infos else None,
+            response,
+        )
+        content = InternalMessageContent(
+            content_type=InternalMessageContent.CONTENT_TYPE_MESSAGE_RESPONSE,
+            peer_infos=peer_infos,
+            data=response,
+            command_uuid=command_uuid,
+        )
+        msg = InternalMessage(
+            message_type=InternalMessage.MESSAGE_TYPE_TOELECTRON,
+            content=content,
+        )
+        self.message_queue.put(msg)
 
     def get_cleepbus_headers(self):
         """
@@ -82,6 +454,7 @@ class CleepBus:
         Returns:
             dict: dict of headers (only string supported)
         """
+        self.__signature = self.pyrebus.get_interfaces_signature()
         macs = self.pyrebus.get_mac_addresses()
         headers = {
             "uuid": self.uuid,
@@ -93,24 +466,43 @@ class CleepBus:
             "auth": "0",
             "cleepdesktop": "1",
             "apps": json.dumps({}),
+            PyreBus.CODECS_HEADER: json.dumps(self.pyrebus.codecs.get_names()),
+            PyreBus.COMPRESSION_HEADER: self.pyrebus.codecs.COMPRESSION,
+            PyreBus.BATCH_HEADER: "1",
         }
         self.logger.debug("headers: %s", headers)
 
         return headers
 
-    def __on_message_received(self, peer_uuid, message):
+    def __get_channel_message_callback(self, channel):
+        """
+        Return callback handling message received on specified channel
+
+        Args:
+            channel (string): channel name
+
+        Returns:
+            function: message received callback
+        """
+        return lambda peer_uuid, message: self.__on_message_received(
+            peer_uuid, message, channel
+        )
+
+    def __on_message_received(self, peer_uuid, message, channel=None):
         """
         Handle received message from external bus
 
         Args:
             peer_uuid (string): peer identifier
             message (MessageResponse): message from external bus
+            channel (string): channel message was received on (None for default channel)
         """
         self.logger.debug("Message received from %s: %s", peer_uuid, message)
         content = InternalMessageContent(
             content_type=InternalMessageContent.CONTENT_TYPE_MESSAGE_RESPONSE,
             peer_infos=self.peers[peer_uuid],
             data=message,
+            channel=channel,
         )
         msg = InternalMessage(
             message_type=InternalMessage.MESSAGE_TYPE_TOELECTRON,
@@ -134,27 +526,19 @@ class CleepBus:
             return
 
         # save new peer
-        peer_infos.online = True
-        peer_infos.extra["connectedat"] = int(time.time())
-        peer_infos.extra["configured"] = False
-        if (
-            len(peer_infos.hostname.strip()) > 0
-            and peer_infos.hostname != self.UNCONFIGURED_DEVICE_HOSTNAME
-        ):
-            peer_infos.extra["configured"] = True
+        peer_infos.set_online(True)
+        peer_infos.update_extra(
+            {
+                "connectedat": int(time.time()),
+                "configured": len(peer_infos.hostname.strip()) > 0
+                and peer_infos.hostname != self.UNCONFIGURED_DEVICE_HOSTNAME,
+            }
+        )
         self.peers[peer_uuid] = peer_infos
+        self.__peers_changed()
         self.logger.debug("Peer %s connected: %s", peer_uuid, peer_infos)
 
-        # queue message
-        content = InternalMessageContent(
-            content_type=InternalMessageContent.CONTENT_TYPE_PEER_CONNECTED,
-            peer_infos=peer_infos,
-        )
-        msg = InternalMessage(
-            message_type=InternalMessage.MESSAGE_TYPE_TOELECTRON,
-            content=content,
-        )
-        self.message_queue.put(msg)
+        self.presence.push(True, peer_infos)
 
     def __on_peer_disconnected(self, peer_uuid):
         """
@@ -166,13 +550,29 @@ class CleepBus:
         self.logger.info("Peer %s disconnected", peer_uuid)
 
         # update peer
-        peer_infos = self.peers.get(peer_uuid)
-        if peer_infos:
-            peer_infos.online = False
+        peer_infos = self.peers.set_offline(peer_uuid)
+        if not peer_infos:
+            # unknown peer or peer already replaced by its new connection
+            self.logger.debug("Disconnected peer %s is unknown", peer_uuid)
+            return
+        self.__peers_changed()
+
+        self.presence.push(False, peer_infos)
 
-        # queue message
+    def __on_presence_changed(self, connected, peer_infos):
+        """
+        Queue peer presence change (after debouncing) to electron
+
+        Args:
+            connected (bool): True if peer is connected
+            peer_infos (PeerInfos): peer informations
+        """
         content = InternalMessageContent(
-            content_type=InternalMessageContent.CONTENT_TYPE_PEER_DISCONNECTED,
+            content_type=(
+                InternalMessageContent.CONTENT_TYPE_PEER_CONNECTED
+                if connected
+                else InternalMessageContent.CONTENT_TYPE_PEER_DISCONNECTED
+            ),
             peer_infos=peer_infos,
         )
         msg = InternalMessage(
@@ -188,30 +588,64 @@ class CleepBus:
         It is used to transform peer connection infos to appropriate python type (all values in
         infos are string).
 
+        Decoded infos are cached by raw infos (devices reconnect with the same headers), each
+        call returns a new PeerInfos built from cached template sharing its frozen macs and
+        extra (only ident, ip and online are set per connection).
+
         Args:
             infos (dict): dict of decoded values
 
         Returns:
             PeerInfos: peer informations
         """
+        key = tuple(sorted(infos.items()))
+        template = self.peer_headers_cache.get(key)
+        if template is None:
+            template = self.__decode_peer_headers(infos)
+            self.peer_headers_cache.set(key, template)
+
+        return PeerInfos(
+            uuid=template["uuid"],
+            hostname=template["hostname"],
+            port=template["port"],
+            ssl=template["ssl"],
+            auth=template["auth"],
+            macs=template["macs"],
+            cleepdesktop=template["cleepdesktop"],
+            extra=template["extra"],
+        )
+
+    def __decode_peer_headers(self, infos):
+        """
+        Decode peer headers to deeply read-only template
+
+        Args:
+            infos (dict): dict of decoded values
+
+        Returns:
+            FrozenDict: read-only decoded peer infos (nested values frozen too)
+        """
         self.logger.debug("Raw value to decode: %s", infos)
-        peer_infos = PeerInfos()
-        peer_infos.uuid = infos.get("uuid", None)
-        peer_infos.hostname = infos.get("hostname", None)
-        peer_infos.port = int(infos.get("port", peer_infos.port))
-        peer_infos.ssl = bool(str2bool(infos.get("ssl", f"{peer_infos.ssl}")))
-        peer_infos.auth = bool(str2bool(infos.get("auth", f"{peer_infos.auth}")))
-        peer_infos.cleepdesktop = bool(
-            str2bool(infos.get("cleepdesktop", f"{peer_infos.cleepdesktop}"))
-        )
-        peer_infos.macs = json.loads(infos.get("macs", "[]"))
-        peer_infos.extra = {
+        defaults = PeerInfos()
+        extra = {
             key: self.decode_header_value(key, value)
             for key, value in infos.items()
             if key not in ["uuid", "hostname", "port", "ssl", "cleepdesktop", "macs"]
         }
-
-        return peer_infos
+        return freeze_value(
+            {
+                "uuid": infos.get("uuid", None),
+                "hostname": infos.get("hostname", None),
+                "port": int(infos.get("port", defaults.port)),
+                "ssl": bool(str2bool(infos.get("ssl", f"{defaults.ssl}"))),
+                "auth": bool(str2bool(infos.get("auth", f"{defaults.auth}"))),
+                "cleepdesktop": bool(
+                    str2bool(infos.get("cleepdesktop", f"{defaults.cleepdesktop}"))
+                ),
+                "macs": json.loads(infos.get("macs", "[]")),
+                "extra": extra,
+            }
+        )
 
     @staticmethod
     def decode_header_value(key, value):
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class Codec:
+    """
+    Bus payload codec base class
+
+    Binary codecs prefix payload with their marker byte to be identified when decoding. Json codec
+    has no marker to stay compatible with devices that do not support codecs.
+    """
+
+    NAME = None
+    MARKER = None
+
+    @staticmethod
+    def is_available():
+        """
+        Return True if codec can be used (dependencies installed)
+
+        Returns:
+            bool: True if codec is available
+        """
+        return True
+
+    def encode(self, message):
+        """
+        Encode message
+
+        Args:
+            message (dict): message to encode
+
+        Returns:
+            bytes: encoded message
+
+        Warning:
+            Must be implemented
+        """
+        raise NotImplementedError(
+            f'encode function must be implemented in "{self.__class__.__name__}"'
+        )
+
+    def decode(self, payload):
+        """
+        Decode payload
+
+        Args:
+            payload (bytes): payload to decode
+
+        Returns:
+            dict: decoded message
+
+        Warning:
+            Must be implemented
+        """
+        raise NotImplementedError(
+            f'decode function must be implemented in "{self.__class__.__name__}"'
+        )
+
+
+class JsonCodec(Codec):
+    """
+    Json codec (default)
+    """
+
+    NAME = "json"
+
+    def encode(self, message):
+        return json.dumps(message).encode("utf-8")
+
+    def decode(self, payload):
+        return json.loads(payload.decode("utf-8"))
+
+
+class MsgpackCodec(Codec):
+    """
+    MessagePack codec (needs msgpack package)
+    """
+
+    NAME = "msgpack"
+    MARKER = b"\x01"
+
+    @staticmethod
+    def is_available():
+        return msgpack is not None
+
+    def encode(self, message):
+        return self.MARKER + msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload[1:], raw=False)
+
+
+class Codecs:
+    """
+    Available codecs registry
+
+    It also handles zlib compression of large payloads. Compressed payload is prefixed by
+    COMPRESSION_MARKER byte.
+    """
+
+    # codecs by preference order, default one last
+    CODECS = [MsgpackCodec, JsonCodec]
+
+    COMPRESSION = "zlib"
+    COMPRESSION_MARKER = b"\x02"
+    COMPRESSION_THRESHOLD = 4096  # bytes
+    MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024  # bytes
+
+    def __init__(self, compression_threshold=None):
+        """
+        Constructor
+
+        Args:
+            compression_threshold (int): payload size above which payload is compressed.
+                                         Default COMPRESSION_THRESHOLD
+        """
+        self.compression_threshold = (
+            compression_threshold or self.COMPRESSION_THRESHOLD
+        )
+        self.__compression_stats = {
+            "compressed": 0,
+            "bytesin": 0,
+            "bytesout": 0,
+            "compresstime": 0.0,
+            "decompressed": 0,
+            "decompresstime": 0.0,
+            "rejected": 0,
+        }
+        self.__codecs = [codec() for codec in self.CODECS if codec.is_available()]
+        self.__codecs_by_marker = {
+            codec.MARKER: codec for codec in self.__codecs if codec.MARKER
+        }
+        self.default = self.__codecs[-1]
+
+    def get_names(self):
+        """
+        Return names of available codecs by preference order
+
+        Returns:
+            list: list of codec names
+        """
+        return [codec.NAME for codec in self.__codecs]
+
+    def select(self, peer_codecs):
+        """
+        Select best codec supported by peer
+
+        Args:
+            peer_codecs (list): list of codec names supported by peer (None if peer does not
+                                advertise codecs)
+
+        Returns:
+            Codec: best common codec or default one
+        """
+        if peer_codecs:
+            for codec in self.__codecs:
+                if codec.NAME in peer_codecs:
+                    return codec
+
+        return self.default
+
+    def compress(self, payload):
+        """
+        Compress payload if its size is above compression threshold
+
+        Args:
+            payload (bytes): encoded payload
+
+        Returns:
+            bytes: compressed payload or original one if compression is useless
+        """
+        if len(payload) < self.compression_threshold:
+            return payload
+
+        start = time.perf_counter()
+        compressed = self.COMPRESSION_MARKER + zlib.compress(payload)
+        self.__compression_stats["compresstime"] += time.perf_counter() - start
+        if len(compressed) >= len(payload):
+            return payload
+
+        self.__compression_stats["compressed"] += 1
+        self.__compression_stats["bytesin"] += len(payload)
+        self.__compression_stats["bytesout"] += len(compressed)
+        return compressed
+
+    def get_compression_stats(self):
+        """
+        Return compression stats
+
+        Returns:
+            dict: compression stats::
+
+            {
+                compressed (int): number of compressed payloads
+                bytesin (int): size of payloads before compression
+                bytesout (int): size of payloads after compression
+                ratio (float): compression ratio (bytesout / bytesin)
+                compresstime (float): time spent compressing payloads in seconds
+                decompressed (int): number of decompressed payloads
+                decompresstime (float): time spent decompressing payloads in seconds
+                rejected (int): number of compressed payloads rejected (too large once
+                                decompressed)
+            }
+
+        """
+        stats = dict(self.__compression_stats)
+        stats["ratio"] = (
+            stats["bytesout"] / stats["bytesin"] if stats["bytesin"] else 1.0
+        )
+        return stats
+
+    def decode(self, payload):
+        """
+        Decode payload with codec identified by its marker, decompressing it if necessary
+
+        Args:
+            payload (bytes): payload to decode
+
+        Returns:
+            dict: decoded message
+
+        Raises:
+            ValueError: if decompressed payload is larger than MAX_DECOMPRESSED_SIZE
+        """
+        if payload[:1] == self.COMPRESSION_MARKER:
+            start = time.perf_counter()
+            decompressor = zlib.decompressobj()
+            # bounded decompression: a small payload can expand to a huge one (zlib bomb)
+            decompressed = decompressor.decompress(payload[1:], self.MAX_DECOMPRESSED_SIZE)
+            self.__compression_stats["decompresstime"] += time.perf_counter() - start
+            if decompressor.unconsumed_tail:
+                self.__compression_stats["rejected"] += 1
+                raise ValueError(
+                    f"Decompressed payload exceeds {self.MAX_DECOMPRESSED_SIZE} bytes"
+                )
+            payload = decompressed
+            self.__compression_stats["decompressed"] += 1
+
+        codec = self.__codecs_by_marker.get(payload[:1], self.default)
+        return codec.decode(payload)
@@ -1,5 +1,9 @@
 import copy
+import json
 import sys
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
 from exception import InvalidMessage
 
 
@@ -12,7 +16,11 @@ class InternalMessageContent:
     CONTENT_TYPE_PEER_DISCONNECTED = "PEER_DISCONNECTED"
     CONTENT_TYPE_MESSAGE_RESPONSE = "MESSAGE_RESPONSE"
 
-    def __init__(self, content_type, peer_infos, data=None):
+    __slots__ = ("content_type", "peer_infos", "data", "command_uuid", "channel")
+
+    def __init__(
+        self, content_type, peer_infos, data=None, command_uuid=None, channel=None
+    ):
         """
         Constructor
 
@@ -20,10 +28,14 @@ class InternalMessageContent:
             content_type (string): content type (CONTENT_TYPE_XXX)
             peer_infos (PeerInfos): peer informations
             data (any): data depends on content type
+            command_uuid (string): uuid of command the content responds to
+            channel (string): bus channel message was received on (None for default channel)
         """
         self.content_type = content_type
         self.peer_infos = peer_infos
         self.data = data
+        self.command_uuid = command_uuid
+        self.channel = channel
 
     def __str__(self):
         string = f"InternalMessageContent: ${self.content_type} - ${self.peer_infos} - ${self.data}"
@@ -32,13 +44,38 @@ class InternalMessageContent:
     def to_dict(self):
         output = {
             "content_type": self.content_type,
-            "peer_infos": self.peer_infos.to_dict(),
+            "peer_infos": self.peer_infos.to_dict() if self.peer_infos else None,
         }
         if self.data:
             output["data"] = self.data.to_dict()
+        if self.command_uuid:
+            output["command_uuid"] = self.command_uuid
+        if self.channel:
+            output["channel"] = self.channel
 
         return output
 
+    def to_json(self):
+        """
+        Return content serialized in json, same as json.dumps(to_dict()). Peer infos cached
+        json is reused
+
+        Returns:
+            string: json content
+        """
+        output = (
+            f'{{"content_type": {json.dumps(self.content_type)}, '
+            f'"peer_infos": {self.peer_infos.to_json() if self.peer_infos else "null"}'
+        )
+        if self.data:
+            output += f', "data": {json.dumps(self.data.to_dict())}'
+        if self.command_uuid:
+            output += f', "command_uuid": {json.dumps(self.command_uuid)}'
+        if self.channel:
+            output += f', "channel": {json.dumps(self.channel)}'
+
+        return output + "}"
+
 
 class InternalMessage:
     """
@@ -48,6 +85,8 @@ class InternalMessage:
     MESSAGE_TYPE_TOELECTRON = "TO_ELECTRON"
     MESSAGE_TYPE_FROMELECTRON = "FROM_ELECTRON"
 
+    __slots__ = ("message_type", "content", "created_at")
+
     def __init__(self, message_type, content):
         """
         Constructor
@@ -58,6 +97,7 @@ class InternalMessage:
         """
         self.message_type = message_type
         self.content = content
+        self.created_at = time.monotonic()
 
     def __str__(self):
         return "InternalMessage: " + self.message_type + " " + str(self.content)
@@ -66,8 +106,27 @@ class InternalMessage:
 class PeerInfos:
     """
     Stores peer informations
+
+    Peer infos json is cached and invalidated each time a field is set. Macs and extra are
+    frozen (see freeze_value) to prevent in-place modifications: replace them or use
+    update_extra.
     """
 
+    __slots__ = (
+        "__json",
+        "uuid",
+        "ident",
+        "hostname",
+        "ip",
+        "port",
+        "ssl",
+        "auth",
+        "macs",
+        "cleepdesktop",
+        "online",
+        "extra",
+    )
+
     def __init__(
         self,
         uuid=None,
@@ -106,9 +165,10 @@ class PeerInfos:
             Mac addresses are mandatory because they are used to identify a peer that has been reinstalled (and
             has lost its previous uuid)
         """
+        self.__json = None
         self.uuid = uuid
-        self.ident = ident
-        self.hostname = hostname
+        self.ident = intern_string(ident)
+        self.hostname = intern_string(hostname)
         self.ip = ip
         self.port = port
         self.ssl = ssl
@@ -118,6 +178,53 @@ class PeerInfos:
         self.online = False
         self.extra = extra or {}
 
+    def __setattr__(self, name, value):
+        """
+        Set field, freezing macs and extra, and invalidate cached json
+        """
+        if name == "_PeerInfos__json":
+            object.__setattr__(self, name, value)
+            return
+        if name in ("macs", "extra"):
+            value = freeze_value(value)
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, "_PeerInfos__json", None)
+
+    def invalidate(self):
+        """
+        Invalidate cached json
+        """
+        self.__json = None
+
+    def set_online(self, online):
+        """
+        Set peer online status
+
+        Args:
+            online (bool): True if peer is online
+        """
+        self.online = online
+
+    def update_extra(self, extra):
+        """
+        Update peer extra informations
+
+        Args:
+            extra (dict): extra informations to add or replace
+        """
+        self.extra = {**self.extra, **extra}
+
+    def to_json(self):
+        """
+        Return peer infos serialized in json (cached)
+
+        Returns:
+            string: json peer infos
+        """
+        if self.__json is None:
+            self.__json = json.dumps(self.to_dict())
+        return self.__json
+
     def to_dict(self, with_extra=False):
         """
         Return peer infos as dict
@@ -169,25 +276,27 @@ class PeerInfos:
             )
         )
 
-    def fill_from_dict(self, peer_infos):
+    def fill_from_dict(self, peer_infos, owned=False):
         """
         Fill infos from dict
 
         Args:
             peer_infos (dict): peer informations
+            owned (bool): kept for compatibility, extra data is always frozen (see
+                          freeze_value) and taken as is if it is already frozen
         """
         if not isinstance(peer_infos, dict):
             raise Exception('Parameter "peer_infos" must be a dict')
         self.uuid = peer_infos.get("uuid", None)
-        self.ident = peer_infos.get("ident", None)
-        self.hostname = peer_infos.get("hostname", None)
+        self.ident = intern_string(peer_infos.get("ident", None))
+        self.hostname = intern_string(peer_infos.get("hostname", None))
         self.ip = peer_infos.get("ip", None)
         self.port = peer_infos.get("port", None)
         self.ssl = peer_infos.get("ssl", False)
         self.auth = peer_infos.get("auth", False)
         self.macs = peer_infos.get("macs", None)
         self.cleepdesktop = peer_infos.get("cleepdesktop", False)
-        self.extra = copy.deepcopy(peer_infos.get("extra", {}))
+        self.extra = peer_infos.get("extra", {})
 
 
 class MessageResponse:
@@ -202,6 +311,8 @@ class MessageResponse:
 
     """
 
+    __slots__ = ("error", "message", "data", "broadcast")
+
     def __init__(self, error=False, message="", data=None, broadcast=False):
         """
         Constructor
@@ -232,12 +343,20 @@ class MessageResponse:
         """
         Return message response
         """
-        return {"error": self.error, "message": self.message, "data": self.data}
+        return {
+            "error": self.error,
+            "message": self.message,
+            "data": self.data,
+        }
 
     def fill_from_response(self, response):
         """
         Fill from other response
 
+        Data is frozen (deeply read-only) and shared with other responses filled from this
+        instance (copy on write), use get_mutable_data to modify it. Other response is not
+        modified.
+
         Args:
             response (MessageResponse): message response instance
         """
@@ -246,9 +365,20 @@ class MessageResponse:
 
         self.error = response.error
         self.message = response.message
-        self.data = copy.deepcopy(response.data)
+        self.data = freeze_value(response.data)
         self.broadcast = response.broadcast
 
+    def get_mutable_data(self):
+        """
+        Return data that can be modified, copying it first if it is frozen
+
+        Returns:
+            any: response data
+        """
+        if is_frozen_value(self.data):
+            self.data = thaw_value(self.data)
+        return self.data
+
     def fill_from_dict(self, response):
         """
         Fill from dict
@@ -297,11 +427,26 @@ class MessageRequest:
         sender (string): message sender [command only]
         device_id (string): internal virtual device identifier [event only]
         peer_infos (PeerInfos): peer informations. Must be filled if message comes from outside the device
+        channel (string): external bus channel the message was received on or must be sent to
 
     Note:
         A message cannot be a command and an event, priority to command if both are specified.
     """
 
+    __slots__ = (
+        "command",
+        "event",
+        "params",
+        "to",
+        "propagate",
+        "sender",
+        "device_id",
+        "peer_infos",
+        "command_uuid",
+        "timeout",
+        "channel",
+    )
+
     def __init__(self, command=None, event=None, params=None, to=None):
         """
         Constructor
@@ -312,16 +457,17 @@ class MessageRequest:
             params (dict): message parameter if any
             to (string): message recipient if any
         """
-        self.command = command
-        self.event = event
+        self.command = intern_string(command)
+        self.event = intern_string(event)
         self.params = params or {}
-        self.to = to
+        self.to = intern_string(to)
         self.propagate = False
         self.sender = None
         self.device_id = None
         self.peer_infos = None
         self.command_uuid = None
         self.timeout = None
+        self.channel = None
 
     def __str__(self):
         """
@@ -450,6 +596,10 @@ class MessageRequest:
         """
         Fill instance from other request
 
+        Params are frozen (deeply read-only) and shared with other requests filled from this
+        instance (copy on write), use get_mutable_params to modify them. Other request is not
+        modified.
+
         Args:
             request (MessageRequest): message request instance
         """
@@ -459,39 +609,284 @@ class MessageRequest:
         self.command = request.command
         self.event = request.event
         self.propagate = request.propagate
-        self.params = copy.deepcopy(request.params)
+        self.params = freeze_value(request.params)
         self.to = request.to
         self.sender = request.sender
         self.device_id = request.device_id
         self.peer_infos = None
         self.command_uuid = request.command_uuid
+        self.channel = request.channel
         if request.peer_infos:
             self.peer_infos = PeerInfos()
             self.peer_infos.fill_from_dict(request.peer_infos.to_dict(True))
 
-    def fill_from_dict(self, message):
+    def fill_from_dict(self, message, owned=False):
         """
         Fill instance from other request
 
         Args:
             request (dict): message request infos
+            owned (bool): ownership of dict is transferred to instance (caller must not use it
+                          anymore), params are taken as is instead of being deep copied. Use it
+                          for freshly decoded messages
         """
         if not isinstance(message, dict):
             raise Exception('Parameter "message" must be a dict')
 
-        self.command = message.get("command", None)
-        self.event = message.get("event", None)
+        self.command = intern_string(message.get("command", None))
+        self.event = intern_string(message.get("event", None))
         self.propagate = message.get("propagate", False)
-        self.params = copy.deepcopy(message.get("params", {}))
-        self.to = message.get("to", None)
-        self.sender = message.get("sender", None)
+        params = message.get("params", {})
+        self.params = params if owned else copy.deepcopy(params)
+        self.to = intern_string(message.get("to", None))
+        self.sender = intern_string(message.get("sender", None))
         self.device_id = message.get("device_id", None)
         self.command_uuid = message.get("command_uuid", None)
         self.timeout = message.get("timeout", 5.0)
+        self.channel = message.get("channel", None)
         self.peer_infos = None
         if message.get("peer_infos", None):
             self.peer_infos = PeerInfos()
-            self.peer_infos.fill_from_dict(message.get("peer_infos"))
+            self.peer_infos.fill_from_dict(message.get("peer_infos"), owned)
+
+    def get_mutable_params(self):
+        """
+        Return params that can be modified, copying them first if they are frozen
+
+        Returns:
+            dict: message params
+        """
+        if is_frozen_value(self.params):
+            self.params = thaw_value(self.params)
+        return self.params
+
+
+def intern_string(value):
+    """
+    Intern string to share repeated strings (event names, idents, hostnames...) between messages
+
+    Args:
+        value (any): value to intern
+
+    Returns:
+        any: interned string or value as is if it is not a string
+    """
+    return sys.intern(value) if type(value) is str else value
+
+
+class FrozenDict(dict):
+    """
+    Read-only dict built by freeze_value. It is still a dict so it is serialized (json,
+    msgpack) as is
+    """
+
+    __slots__ = ()
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError("FrozenDict is read-only, use a mutable copy (see thaw_value)")
+
+    __setitem__ = __delitem__ = __ior__ = __readonly
+    clear = pop = popitem = setdefault = update = __readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(tuple):
+    """
+    Read-only list built by freeze_value
+    """
+
+    __slots__ = ()
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def freeze_value(value):
+    """
+    Return deeply read-only copy of json-like value: dicts are turned into FrozenDict and
+    lists into FrozenList. Frozen values are returned as is, they can be shared by several
+    messages
+
+    Args:
+        value (any): value to freeze
+
+    Returns:
+        any: frozen value
+    """
+    if isinstance(value, dict):
+        if type(value) is FrozenDict:
+            return value
+        return FrozenDict({key: freeze_value(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        if type(value) is FrozenList:
+            return value
+        return FrozenList([freeze_value(item) for item in value])
+    return value
+
+
+def is_frozen_value(value):
+    """
+    Return True if value was frozen by freeze_value
+
+    Args:
+        value (any): value to check
+
+    Returns:
+        bool: True if value is frozen
+    """
+    return isinstance(value, (FrozenDict, FrozenList))
+
+
+def thaw_value(value):
+    """
+    Return mutable deep copy of json-like value (frozen or not): mappings are turned into dicts
+    and tuples into lists
+
+    Args:
+        value (any): value to thaw
+
+    Returns:
+        any: mutable value
+    """
+    if isinstance(value, Mapping):
+        return {key: thaw_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw_value(item) for item in value]
+    return value
+
+
+class WakeupsCounter:
+    """
+    Count process wakeups (blocking waits that returned) to follow idle activity
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.started_at = time.monotonic()
+        self.wakeups = 0
+        self.__window_started_at = self.started_at
+        self.__window_wakeups = 0
+
+    def hit(self):
+        """
+        Count a wakeup
+        """
+        self.wakeups += 1
+        self.__window_wakeups += 1
+
+    def get_rate(self):
+        """
+        Return wakeups per second since counter creation
+
+        Returns:
+            float: wakeups per second
+        """
+        elapsed = time.monotonic() - self.started_at
+        return self.wakeups / elapsed if elapsed > 0 else 0.0
+
+    def get_window_rate(self):
+        """
+        Return wakeups per second since previous call (or counter creation), and start a new
+        window
+
+        Returns:
+            float: wakeups per second
+        """
+        now = time.monotonic()
+        elapsed = now - self.__window_started_at
+        rate = self.__window_wakeups / elapsed if elapsed > 0 else 0.0
+        self.__window_started_at = now
+        self.__window_wakeups = 0
+        return rate
+
+    def to_dict(self):
+        """
+        Return counter stats
+
+        Returns:
+            dict: counter stats
+        """
+        return {"wakeups": self.wakeups, "rate": self.get_rate()}
+
+
+class LruCache:
+    """
+    Bounded least recently used cache with hits and misses counters
+    """
+
+    def __init__(self, maxsize):
+        """
+        Constructor
+
+        Args:
+            maxsize (int): max number of cached entries
+        """
+        self.maxsize = maxsize
+        self.__entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        """
+        Return cached value
+
+        Args:
+            key (any): hashable key
+
+        Returns:
+            any: cached value or None if not cached
+        """
+        value = self.__entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.__entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        """
+        Cache value, dropping least recently used entry if cache is full
+
+        Args:
+            key (any): hashable key
+            value (any): value to cache (not None)
+        """
+        self.__entries[key] = value
+        self.__entries.move_to_end(key)
+        if len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+
+    def to_dict(self):
+        """
+        Return cache stats
+
+        Returns:
+            dict: cache stats
+        """
+        return {
+            "size": len(self.__entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
 
 
 _true_set = {"yes", "true", "t", "y", "1"}
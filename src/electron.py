@@ -1,8 +1,9 @@
 import logging
 import websocket
-import json
 from gevent import sleep as gsleep
-from common import InternalMessage
+from gevent.event import Event
+from gevent.socket import wait_read
+from common import InternalMessage, WakeupsCounter
 
 
 class Electron:
@@ -10,6 +11,12 @@ class Electron:
     Electron class to handle communication with CleepDesktop (Electron application)
     """
 
+    BATCH_FLAG = "batch"
+    SNAPSHOT_FLAG = "snapshot"
+
+    CONNECT_RETRY_DELAY = 1.0  # seconds
+    CONNECT_RETRY_MAX_DELAY = 4.0  # seconds
+
     def __init__(self, message_queue, config):
         """
         Args:
@@ -21,6 +28,10 @@ class Electron:
             self.logger.setLevel(logging.DEBUG)
         self.message_queue = message_queue
         self.websocket = None
+        self.connected = Event()
+        self.wakeups = WakeupsCounter()
+        self.__retry_delay = self.CONNECT_RETRY_DELAY
+        self.__on_connected = None
         self.config = config
         if not self.config.get("websocketport", None) or not self.config.get(
             "websocket", False
@@ -40,6 +51,7 @@ class Electron:
         if self.websocket:
             self.logger.info("Disconnected from cleep-desktop")
             self.websocket.close()
+        self.connected.clear()
 
     def is_connected(self):
         """
@@ -49,34 +61,98 @@ class Electron:
         """
         return bool(self.websocket)
 
-    def __connectToWebsocket(self):
+    def is_enabled(self):
+        """
+        Return websocket feature state
+
+        Returns:
+            bool: True if websocket is enabled
+        """
+        return bool(
+            self.config.get("websocketport", None)
+            and self.config.get("websocket", False)
+        )
+
+    def wait_connected(self, timeout=None):
+        """
+        Wait (cooperatively) until websocket is connected
+
+        Args:
+            timeout (float): max time to wait in seconds (default None to wait forever)
+
+        Returns:
+            bool: True if connected to electron
+        """
+        return self.connected.wait(timeout)
+
+    def set_on_connected(self, callback):
+        """
+        Set function called each time websocket is (re)connected, before any other message is sent
+
+        Args:
+            callback (function): function without parameter (None to remove it)
+        """
+        self.__on_connected = callback
+
+    def __connectToWebsocket(self, backoff=False):
         """
         Connect to Electron websocket
+
+        Args:
+            backoff (bool): double retry delay after each failure instead of retrying every second
         """
         try:
             websocketPort = self.config.get("websocketport")
             if websocketPort and self.config.get("websocket", False):
-                self.websocket = websocket.WebSocket()
-                self.websocket.connect(f"ws://127.0.0.1:{websocketPort}", timeout=0.25)
+                ws = websocket.WebSocket()
+                ws.connect(f"ws://127.0.0.1:{websocketPort}", timeout=0.25)
+                self.websocket = ws
+                self.connected.set()
+                self.__retry_delay = self.CONNECT_RETRY_DELAY
                 self.logger.info("Connected to cleep-desktop websocket")
-        except ConnectionRefusedError:
+                if self.__on_connected:
+                    self.__on_connected()
+        except (OSError, websocket.WebSocketException):
             self.logger.info(
                 "Websocket server is not available. Retrying in few seconds"
             )
-            gsleep(1)
+            gsleep(self.__retry_delay)
+            if backoff:
+                self.__retry_delay = min(
+                    self.__retry_delay * 2, self.CONNECT_RETRY_MAX_DELAY
+                )
 
-    def read_message(self):
+    def __disconnected(self):
+        """
+        Reset websocket after disconnection
+        """
+        self.logger.warning("Websocket disconnected")
+        self.websocket = None
+        self.connected.clear()
+
+    def read_message(self, wait=False):
         """
         Read message from websocket and put it in message queue
+
+        Args:
+            wait (bool): cooperatively wait for websocket data before reading it instead of
+                         relying on websocket timeout, and back off connection retries.
+                         Use it when running inside a greenlet.
         """
-        if not self.config.get("websocket", False):
+        if not self.is_enabled():
+            if wait:
+                # nothing will ever be read, do not spin
+                gsleep(self.CONNECT_RETRY_MAX_DELAY)
             return
 
         if not self.websocket:
-            self.__connectToWebsocket()
+            self.__connectToWebsocket(backoff=wait)
             return
 
         try:
+            if wait:
+                wait_read(self.websocket.sock.fileno())
+                self.wakeups.hit()
             message = self.websocket.recv()
             self.logger.debug("Received from electron: %r", message)
             self.message_queue.put(
@@ -87,16 +163,81 @@ class Electron:
             )
         except websocket.WebSocketTimeoutException:
             pass
-        except websocket.WebSocketConnectionClosedException:
-            self.logger.warning("Websocket disconnected")
-            self.websocket = None
+        except (websocket.WebSocketConnectionClosedException, OSError):
+            self.__disconnected()
 
     def send_message(self, message):
         """
         Send message to electron application
 
         Args:
-            message (InternalMessage): message to send
+            message (InternalMessageContent): message to send
+        """
+        if not message:
+            self.logger.info("Trying to send empty message")
+            return
+
+        frame = message.to_json()
+        self.logger.debug("Send message to electron: %s", frame)
+        self.__send_frame(frame)
+
+    def send_messages(self, messages):
+        """
+        Send several messages to electron application in a single websocket frame
+
+        Frame is flagged as batch and holds messages in an array::
+
+            {
+                batch (bool): always True
+                messages (list): list of messages
+            }
+
+        A single message is sent as usual (not flagged as batch). Frame is assembled from
+        messages json.
+
+        Args:
+            messages (list): list of InternalMessageContent to send
+        """
+        messages = [message for message in messages if message]
+        if len(messages) <= 1:
+            if messages:
+                self.send_message(messages[0])
+            return
+
+        self.logger.debug("Send batch of %d messages to electron", len(messages))
+        self.__send_frame(
+            f'{{"{self.BATCH_FLAG}": true, "messages": ['
+            + ", ".join(message.to_json() for message in messages)
+            + "]}"
+        )
+
+    def send_snapshot(self, peers):
+        """
+        Send snapshot of all known peers in a single websocket frame
+
+        Frame is flagged as snapshot::
+
+            {
+                snapshot (bool): always True
+                peers (list): list of peer infos as dict
+            }
+
+        Args:
+            peers (list): list of PeerInfos
+        """
+        self.logger.debug("Send snapshot of %d peers to electron", len(peers))
+        self.__send_frame(
+            f'{{"{self.SNAPSHOT_FLAG}": true, "peers": ['
+            + ", ".join(peer_infos.to_json() for peer_infos in peers)
+            + "]}"
+        )
+
+    def __send_frame(self, frame):
+        """
+        Send frame to electron application
+
+        Args:
+            frame (string): json frame to send
         """
         if not self.config.get("websocket", False):
             return
@@ -105,15 +246,9 @@ class Electron:
             # do not try to connect to websocket here, read_message does it regularly
             return
 
-        if not message:
-            self.logger.info("Trying to send empty message")
-            return
-
         try:
-            self.logger.debug("Send message to electron: %s", message.to_dict())
-            self.websocket.send(json.dumps(message.to_dict()))
+            self.websocket.send(frame)
         except websocket.WebSocketTimeoutException:
             pass
         except websocket.WebSocketConnectionClosedException:
-            self.logger.warning("Websocket disconnected")
-            self.websocket = None
+            self.__disconnected()
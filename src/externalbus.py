@@ -2,8 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import time
 import uuid
-from common import MessageRequest, MessageResponse
+import gevent
+from gevent.event import AsyncResult
+from common import MessageRequest, MessageResponse, PeerInfos
+from exception import InvalidMessage
+from timerwheel import TimerWheel
 
 
 class ExternalBus:
@@ -21,6 +26,9 @@ class ExternalBus:
     """
 
     COMMAND_RESPONSE_EVENT = "external.command.response"
+    COMMAND_BATCH_EVENT = "external.command.batch"
+    COMMAND_BATCH_RESPONSE_EVENT = "external.command.batch.response"
+    COMMAND_TIMEOUT = 5.0  # seconds
 
     def __init__(
         self,
@@ -65,6 +73,15 @@ class ExternalBus:
         #   }
         # }
         self.__manual_responses = {}
+        # pending commands expiry
+        self.__commands_wheel = TimerWheel()
+        self.__expired_commands = 0
+        # message received callbacks by channel
+        self.__channel_callbacks = {}
+        # greenlet running bus loop (None if bus is driven by run_once calls)
+        self._loop_greenlet = None
+        # greenlet currently processing bus in run_once (None if bus is not processed)
+        self._run_once_greenlet = None
 
         # logging
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -73,10 +90,13 @@ class ExternalBus:
         else:
             self.logger.setLevel(logging.INFO)
 
-    def run(self):
+    def run(self, blocking=False):
         """
         Run external bus process
 
+        Args:
+            blocking (bool): wait for events without periodic timeout
+
         Warning:
             Must be implemented
         """
@@ -84,10 +104,35 @@ class ExternalBus:
             f'run function must be implemented in "{self.__class__.__name__}"'
         )
 
-    def run_once(self):
+    def run_once(self, budget=None, blocking=False):
+        """
+        Run external bus process once (see _run_once), remembering greenlet processing bus
+
+        Args:
+            budget (int): max number of frames to handle
+            blocking (bool): wait for events without timeout
+
+        Returns:
+            int: number of handled frames
+        """
+        previous_greenlet = self._run_once_greenlet
+        self._run_once_greenlet = gevent.getcurrent()
+        try:
+            return self._run_once(budget, blocking)
+        finally:
+            self._run_once_greenlet = previous_greenlet
+
+    def _run_once(self, budget, blocking):
         """
         Run external bus process once
 
+        Args:
+            budget (int): max number of frames to handle
+            blocking (bool): wait for events without timeout
+
+        Returns:
+            int: number of handled frames
+
         Warning:
             Must be implemented
         """
@@ -95,6 +140,87 @@ class ExternalBus:
             f'run_once function must be implemented in "{self.__class__.__name__}"'
         )
 
+    def is_running(self):
+        """
+        Return True if external bus is running
+
+        Returns:
+            bool: True if bus is running
+
+        Warning:
+            Must be implemented
+        """
+        raise NotImplementedError(
+            f'is_running function must be implemented in "{self.__class__.__name__}"'
+        )
+
+    def set_channel_callback(self, channel, callback):
+        """
+        Set specific message received callback for messages received on channel
+
+        Args:
+            channel (string): channel name
+            callback (callback): function called when message is received on channel (same
+                                 parameters than on_message_received). None to remove it
+        """
+        if callback:
+            self.__channel_callbacks[channel] = callback
+        else:
+            self.__channel_callbacks.pop(channel, None)
+
+    def get_pending_commands_count(self):
+        """
+        Return number of sent commands still waiting for a response
+
+        Returns:
+            int: number of pending commands
+        """
+        return len(self.__manual_responses)
+
+    def get_expired_commands_count(self):
+        """
+        Return number of sent commands that expired without response
+
+        Returns:
+            int: number of expired commands
+        """
+        return self.__expired_commands
+
+    def get_commands_expiry_timeout(self):
+        """
+        Return max time to wait before calling expire_pending_commands
+
+        Returns:
+            float: timeout in seconds or None if no command is pending
+        """
+        return self.__commands_wheel.get_next_timeout()
+
+    def expire_pending_commands(self):
+        """
+        Expire pending commands that reached their timeout, sending a timeout response to
+        their manual response callback
+
+        Returns:
+            int: number of expired commands
+        """
+        expired = self.__commands_wheel.expire()
+        for command_uuid in expired:
+            pending = self.__manual_responses.pop(command_uuid, None)
+            if not pending:
+                continue
+            self.__expired_commands += 1
+            self.logger.debug('Command with uuid "%s" timed out', command_uuid)
+            if not pending["manual_response"]:
+                continue
+            try:
+                pending["manual_response"](
+                    MessageResponse(error=True, message="Command timeout")
+                )
+            except Exception:
+                self.logger.exception("Error sending command timeout response")
+
+        return len(expired)
+
     def __ack_command_with_response(self, message):
         """
         Ack command sending received response
@@ -103,28 +229,50 @@ class ExternalBus:
             message (MessageRequest): message request
         """
         self.logger.debug("Send internal command response: %s", message)
-        if not message.command_uuid in self.__manual_responses:
+        self.__ack_command(message.command_uuid, message.params)
+
+    def __ack_commands_with_batch_response(self, message):
+        """
+        Ack commands sending responses received in a batch response
+
+        Args:
+            message (MessageRequest): batch response message request
+        """
+        self.logger.debug("Send internal commands batch response: %s", message)
+        for entry in message.params.get("responses", []):
+            self.__ack_command(entry.get("command_uuid"), entry.get("response", {}))
+
+    def __ack_command(self, command_uuid, response_dict):
+        """
+        Ack command sending response to its manual response callback
+
+        Args:
+            command_uuid (string): command uuid
+            response_dict (dict): command response as dict
+        """
+        if not command_uuid in self.__manual_responses:
             self.logger.warning(
                 'Command with uuid "%s" not referenced for sending response',
-                message.command_uuid,
+                command_uuid,
             )
             return
 
         # prepare response from request
         response = MessageResponse()
-        response.fill_from_dict(message.params)
+        response.fill_from_dict(response_dict)
 
         # ack command
         self.logger.debug("Send internal command response back: %s", response)
-        if self.__manual_responses[message.command_uuid]["manual_response"]:
-            self.__manual_responses[message.command_uuid]["manual_response"](response)
+        if self.__manual_responses[command_uuid]["manual_response"]:
+            self.__manual_responses[command_uuid]["manual_response"](response)
         else:
             self.logger.warning(
                 "No manual response specified for external command. Internal command will terminate after timeout."
             )
 
         # clean
-        del self.__manual_responses[message.command_uuid]
+        self.__commands_wheel.remove(command_uuid)
+        del self.__manual_responses[command_uuid]
 
     def on_message_received(self, peer_id, message):
         """
@@ -138,9 +286,35 @@ class ExternalBus:
             # send response for received command
             self.__ack_command_with_response(message)
             return
+        if message.event == ExternalBus.COMMAND_BATCH_RESPONSE_EVENT:
+            # send responses for received commands batch
+            self.__ack_commands_with_batch_response(message)
+            return
+        if message.event == ExternalBus.COMMAND_BATCH_EVENT:
+            # process each command of batch and send all responses at once
+            self.__process_commands_batch(peer_id, message)
+            return
 
         # process message
-        response = self._on_message_received(peer_id, message)
+        response = self.__process_message(peer_id, message)
+        if response:
+            self._send_command_response_to_peer(message, response)
+
+    def __process_message(self, peer_id, message):
+        """
+        Process received message calling message received callback
+
+        Args:
+            peer_id (string): peer identifier
+            message (MessageRequest): request message
+
+        Returns:
+            MessageResponse: command response to send back or None
+        """
+        on_message_received = self.__channel_callbacks.get(
+            message.channel, self._on_message_received
+        )
+        response = on_message_received(peer_id, message)
         self.logger.debug("Command response: %s", response)
 
         if response and message.is_command():
@@ -150,12 +324,47 @@ class ExternalBus:
                     "Unable to send command response because command uuid is missing in %s",
                     message,
                 )
-                return
+                return None
             if not isinstance(response, MessageResponse):
                 raise Exception(
                     f'Command response must be a MessageResponse instance not "{type(response).__name__}"'
                 )
-            self._send_command_response_to_peer(message, response)
+            return response
+
+        return None
+
+    def __process_commands_batch(self, peer_id, message):
+        """
+        Process commands of received batch and send their responses in a single batch response
+
+        Args:
+            peer_id (string): peer identifier
+            message (MessageRequest): batch message request
+        """
+        responses = []
+        for command in message.params.get("commands", []):
+            request = MessageRequest()
+            request.fill_from_dict(command, owned=True)
+            request.peer_infos = message.peer_infos
+            request.channel = message.channel
+            try:
+                response = self.__process_message(peer_id, request)
+            except Exception:
+                self.logger.exception("Error processing batched command %s", request)
+                response = MessageResponse(error=True, message="Command failed")
+            if response:
+                responses.append(
+                    {"command_uuid": request.command_uuid, "response": response.to_dict()}
+                )
+
+        if not responses:
+            return
+        batch_response = MessageRequest()
+        batch_response.event = ExternalBus.COMMAND_BATCH_RESPONSE_EVENT
+        batch_response.params = {"responses": responses}
+        batch_response.peer_infos = message.peer_infos or PeerInfos(ident=peer_id)
+        self.logger.debug("Send commands batch response to peer: %s", batch_response)
+        self._send_message(batch_response)
 
     def _send_command_response_to_peer(self, request, response):
         """
@@ -184,16 +393,18 @@ class ExternalBus:
 
         Args:
             message (MessageRequest): message request instance
-            timeout (float): command timeout
+            timeout (float): command timeout. Command response callback is called with an error
+                             response if no response is received before it
             manual_response (function): function to call to send back command response
         """
         if message.is_command():
             # it's a command, fill request with command identifier and timeout
             message.command_uuid = str(uuid.uuid4())
-            message.timeout = timeout
+            message.timeout = timeout or self.COMMAND_TIMEOUT
             self.__manual_responses[message.command_uuid] = {
                 "manual_response": manual_response,
             }
+            self.__commands_wheel.add(message.command_uuid, message.timeout)
 
             # send command now, response should be returned by event
             self._send_message(message)
@@ -205,6 +416,208 @@ class ExternalBus:
             else:
                 self._broadcast_message(message)
 
+    def send_commands(self, messages, timeout=COMMAND_TIMEOUT, manual_responses=None):
+        """
+        Send several commands to the same peer
+
+        Commands are sent in a single batch envelope if peer supports it, one by one otherwise.
+        Each command has its own command uuid, timeout and response.
+
+        Args:
+            messages (list): list of command MessageRequest to the same peer (same device uuid or
+                             same peer ident)
+            timeout (float): timeout of commands without their own timeout
+            manual_responses (list): list of functions to call to send back each command
+                                     response (same order than messages)
+
+        Raises:
+            InvalidMessage: if a message is not a command or commands are not sent to the same peer
+        """
+        manual_responses = manual_responses or [None] * len(messages)
+        peer_idents = {
+            (message.peer_infos.uuid or message.peer_infos.ident)
+            if message.peer_infos
+            else None
+            for message in messages
+        }
+        if (
+            not all(message.is_command() for message in messages)
+            or len(peer_idents) != 1
+            or None in peer_idents
+        ):
+            raise InvalidMessage()
+        peer_ident = peer_idents.pop()
+
+        if len(messages) == 1 or not self._is_batch_supported(peer_ident):
+            for message, manual_response in zip(messages, manual_responses):
+                self.send_message(message, message.timeout or timeout, manual_response)
+            return
+
+        commands = []
+        for message, manual_response in zip(messages, manual_responses):
+            message.command_uuid = str(uuid.uuid4())
+            message.timeout = message.timeout or timeout or self.COMMAND_TIMEOUT
+            self.__manual_responses[message.command_uuid] = {
+                "manual_response": manual_response,
+            }
+            self.__commands_wheel.add(message.command_uuid, message.timeout)
+            commands.append(ExternalBus.clean_message(message))
+
+        batch = MessageRequest()
+        batch.event = ExternalBus.COMMAND_BATCH_EVENT
+        batch.params = {"commands": commands}
+        batch.peer_infos = messages[0].peer_infos
+        batch.channel = messages[0].channel
+        self.logger.debug("Send batch of %d commands to %s", len(commands), peer_ident)
+        self._send_message(batch)
+
+    def _is_batch_supported(self, peer_ident):
+        """
+        Return True if peer supports commands batch envelope
+
+        Args:
+            peer_ident (string): peer identifier or device uuid
+
+        Returns:
+            bool: True if peer supports commands batch. Default False
+        """
+        return False
+
+    @staticmethod
+    def clean_message(message):
+        """
+        Clean message removing useless field for external messaging
+
+        Args:
+            message (MessageRequest): message request instance
+
+        Returns:
+            dict: cleaned message request
+        """
+        message_dict = message.to_dict()
+        message_dict.pop("startup", None)
+        message_dict.pop("broadcast", None)
+        message_dict.pop("peer_infos", None)
+
+        return message_dict
+
+    def send_command(self, message, timeout=COMMAND_TIMEOUT):
+        """
+        Send command to peer and return future resolved with its response
+
+        Future is resolved with an error response if command times out.
+
+        Args:
+            message (MessageRequest): command message request instance
+            timeout (float): command timeout
+
+        Returns:
+            AsyncResult: future resolved with command MessageResponse
+
+        Raises:
+            InvalidMessage: if message is not a command
+        """
+        if not message.is_command():
+            raise InvalidMessage()
+
+        result = AsyncResult()
+        self.send_message(message, timeout=timeout, manual_response=result.set)
+        return result
+
+    def gather_commands(self, message, peer_idents, timeout=COMMAND_TIMEOUT, run_bus=None):
+        """
+        Send same command to several peers at once and wait for their responses until deadline
+
+        Responses are received by bus loop: if no greenlet runs it (polling mode), gather drives
+        bus calling run_once while waiting. It cannot be called while bus is processed (from
+        bus loop greenlet or from a message callback).
+
+        Args:
+            message (MessageRequest): command message request instance (peer infos is ignored)
+            peer_idents (list): list of peer identifiers
+            timeout (float): deadline in seconds to receive all responses
+            run_bus (bool): call run_once while waiting. Set it to False if bus is driven by
+                            another greenlet. Default True if bus loop is not running and no
+                            other greenlet is processing bus
+
+        Returns:
+            dict: responses received before deadline by peer ident (partial results). Peers
+                  that did not respond in time are missing or have a timeout error response::
+
+            {
+                peer ident (string): MessageResponse,
+                ...
+            }
+
+        Raises:
+            InvalidMessage: if message is not a command
+            Exception: if called while bus is processed
+        """
+        if not message.is_command():
+            raise InvalidMessage()
+        current = gevent.getcurrent()
+        if current in (self._run_once_greenlet, self._loop_greenlet):
+            raise Exception("Unable to gather commands responses from bus loop")
+        if run_bus is None:
+            run_bus = self._loop_greenlet is None and self._run_once_greenlet is None
+
+        deadline = time.monotonic() + timeout
+        # params are frozen once and shared by all peers requests
+        template = MessageRequest()
+        template.fill_from_request(message)
+        futures = {}
+        for peer_ident in peer_idents:
+            request = MessageRequest()
+            request.fill_from_request(template)
+            request.peer_infos = PeerInfos(ident=peer_ident)
+            futures[peer_ident] = self.send_command(request, timeout=timeout)
+
+        pending = list(futures.values())
+        if run_bus:
+            # nobody else reads bus, responses and timeouts are handled by run_once
+            while not all(future.ready() for future in pending):
+                if time.monotonic() >= deadline or not self.is_running():
+                    break
+                self.run_once()
+        else:
+            gevent.wait(pending, timeout=max(deadline - time.monotonic(), 0.0))
+        return {
+            peer_ident: future.get_nowait()
+            for peer_ident, future in futures.items()
+            if future.ready()
+        }
+
+    def multicast_message(self, message, peer_idents):
+        """
+        Send event message to several peers at once
+
+        Args:
+            message (MessageRequest): message request instance
+            peer_idents (list): list of peer identifiers
+
+        Raises:
+            InvalidMessage: if message is a command (command is awaiting a single response)
+        """
+        if message.is_command():
+            raise InvalidMessage()
+
+        self._multicast_message(message, peer_idents)
+
+    def _multicast_message(self, message, peer_idents):
+        """
+        Send event message to several peers
+
+        Args:
+            message (MessageRequest): message instance
+            peer_idents (list): list of peer identifiers
+
+        Warning:
+            Must be implemented
+        """
+        raise NotImplementedError(
+            f'multicast_message function is not implemented "{self.__class__.__name__}"'
+        )
+
     def _broadcast_message(self, message):
         """
         broadcast event message to all connected peers
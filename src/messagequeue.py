@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from collections import deque
+from queue import Empty, Full
+from gevent.event import Event
+from common import InternalMessage, InternalMessageContent, MessageResponse
+
+
+class Lane:
+    """
+    Message queue lane
+    """
+
+    def __init__(self, name, policy, maxsize):
+        """
+        Constructor
+
+        Args:
+            name (string): lane name
+            policy (string): overflow policy (MessageQueue.POLICY_XXX)
+            maxsize (int): max number of messages in lane
+        """
+        self.name = name
+        self.policy = policy
+        self.maxsize = maxsize
+        # queued entries as [key, message] to allow in place coalescing
+        self.entries = deque()
+        self.keys = {}
+        self.drops = 0
+        self.coalesced = 0
+
+    def is_full(self):
+        """
+        Return True if lane is full
+
+        Returns:
+            bool: True if lane is full
+        """
+        return len(self.entries) >= self.maxsize
+
+    def append(self, key, message):
+        """
+        Append message to lane
+
+        Args:
+            key (any): coalescing key (None if message cannot be coalesced)
+            message (InternalMessage): message to append
+        """
+        entry = [key, message]
+        self.entries.append(entry)
+        if key is not None:
+            self.keys[key] = entry
+
+    def popleft(self):
+        """
+        Pop oldest message from lane
+
+        Returns:
+            InternalMessage: oldest message
+        """
+        entry = self.entries.popleft()
+        key, message = entry
+        if key is not None and self.keys.get(key) is entry:
+            del self.keys[key]
+        return message
+
+    def to_dict(self):
+        """
+        Return lane stats
+
+        Returns:
+            dict: lane stats
+        """
+        return {
+            "policy": self.policy,
+            "depth": len(self.entries),
+            "maxsize": self.maxsize,
+            "drops": self.drops,
+            "coalesced": self.coalesced,
+        }
+
+
+class MessageQueue:
+    """
+    Multi-lane queue for InternalMessage
+
+    Messages are dispatched in lanes according to their type. Lanes are served by priority
+    order (first lane first) and each lane has its own overflow policy:
+
+        * block: put waits for free slot (like standard queue)
+        * drop-oldest: oldest message is dropped to make room for new one
+        * coalesce: message replaces queued message of the same peer, keeping only last state.
+          Lane blocks when full and no message can be coalesced
+
+    It exposes the same get/put api than standard queue and raises the same Empty and Full
+    exceptions.
+    """
+
+    POLICY_BLOCK = "block"
+    POLICY_DROP_OLDEST = "drop-oldest"
+    POLICY_COALESCE = "coalesce"
+
+    LANE_PRESENCE = "presence"
+    LANE_CONTROL = "control"
+    LANE_BULK = "bulk"
+
+    # lanes by priority order: (name, policy, maxsize)
+    LANES = [
+        (LANE_PRESENCE, POLICY_COALESCE, 500),
+        (LANE_CONTROL, POLICY_BLOCK, 100),
+        (LANE_BULK, POLICY_DROP_OLDEST, 100),
+    ]
+
+    def __init__(self, lanes=None):
+        """
+        Constructor
+
+        Args:
+            lanes (list): list of lanes (name, policy, maxsize) by priority order. Default LANES
+        """
+        self.__lanes = [
+            Lane(name, policy, maxsize)
+            for name, policy, maxsize in (lanes or self.LANES)
+        ]
+        self.__lanes_by_name = {lane.name: lane for lane in self.__lanes}
+        self.__not_empty = Event()
+        self.__not_full = Event()
+
+    @staticmethod
+    def get_lane_name(message):
+        """
+        Return lane name of specified message
+
+        Args:
+            message (InternalMessage): message
+
+        Returns:
+            string: lane name
+        """
+        if message.message_type == InternalMessage.MESSAGE_TYPE_FROMELECTRON:
+            return MessageQueue.LANE_CONTROL
+
+        content_type = getattr(message.content, "content_type", None)
+        if content_type in (
+            InternalMessageContent.CONTENT_TYPE_PEER_CONNECTED,
+            InternalMessageContent.CONTENT_TYPE_PEER_DISCONNECTED,
+        ):
+            return MessageQueue.LANE_PRESENCE
+        if isinstance(getattr(message.content, "data", None), MessageResponse):
+            # command response
+            return MessageQueue.LANE_CONTROL
+
+        return MessageQueue.LANE_BULK
+
+    @staticmethod
+    def get_coalesce_key(message):
+        """
+        Return coalescing key of specified message
+
+        Args:
+            message (InternalMessage): message
+
+        Returns:
+            string: peer ident or None if message cannot be coalesced
+        """
+        peer_infos = getattr(message.content, "peer_infos", None)
+        return peer_infos.ident if peer_infos else None
+
+    def __get_lane(self, message):
+        """
+        Return lane of specified message, last lane if lane name is unknown
+
+        Args:
+            message (InternalMessage): message
+
+        Returns:
+            Lane: message lane
+        """
+        return self.__lanes_by_name.get(self.get_lane_name(message), self.__lanes[-1])
+
+    def put(self, message, block=True, timeout=None):
+        """
+        Put message in queue
+
+        Args:
+            message (InternalMessage): message to queue
+            block (bool): wait for free slot if lane is full
+            timeout (float): max time to wait in seconds (default None to wait forever)
+
+        Raises:
+            Full: if lane is full
+        """
+        lane = self.__get_lane(message)
+        key = None
+        if lane.policy == self.POLICY_COALESCE:
+            key = self.get_coalesce_key(message)
+            entry = lane.keys.get(key) if key is not None else None
+            if entry:
+                entry[1] = message
+                lane.coalesced += 1
+                return
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while lane.is_full():
+            if lane.policy == self.POLICY_DROP_OLDEST:
+                lane.popleft()
+                lane.drops += 1
+                break
+            if not block:
+                raise Full
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise Full
+            self.__not_full.clear()
+            self.__not_full.wait(remaining)
+
+        lane.append(key, message)
+        self.__not_empty.set()
+
+    def put_nowait(self, message):
+        """
+        Put message in queue without waiting
+
+        Args:
+            message (InternalMessage): message to queue
+
+        Raises:
+            Full: if lane is full
+        """
+        self.put(message, block=False)
+
+    def get(self, block=True, timeout=None):
+        """
+        Get message from queue, higher priority lane first
+
+        Args:
+            block (bool): wait for message if queue is empty
+            timeout (float): max time to wait in seconds (default None to wait forever)
+
+        Returns:
+            InternalMessage: message
+
+        Raises:
+            Empty: if queue is empty
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for lane in self.__lanes:
+                if lane.entries:
+                    message = lane.popleft()
+                    self.__not_full.set()
+                    return message
+
+            if not block:
+                raise Empty
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise Empty
+            self.__not_empty.clear()
+            self.__not_empty.wait(remaining)
+
+    def get_nowait(self):
+        """
+        Get message from queue without waiting
+
+        Returns:
+            InternalMessage: message
+
+        Raises:
+            Empty: if queue is empty
+        """
+        return self.get(block=False)
+
+    def clear_lane(self, name):
+        """
+        Drop all queued messages of specified lane
+
+        Args:
+            name (string): lane name
+
+        Returns:
+            int: number of dropped messages
+        """
+        lane = self.__lanes_by_name.get(name)
+        if not lane:
+            return 0
+
+        count = len(lane.entries)
+        lane.entries.clear()
+        lane.keys.clear()
+        if count:
+            self.__not_full.set()
+        return count
+
+    def qsize(self):
+        """
+        Return number of queued messages
+
+        Returns:
+            int: number of queued messages
+        """
+        return sum(len(lane.entries) for lane in self.__lanes)
+
+    def empty(self):
+        """
+        Return True if queue is empty
+
+        Returns:
+            bool: True if queue is empty
+        """
+        return self.qsize() == 0
+
+    def get_stats(self):
+        """
+        Return lanes stats
+
+        Returns:
+            dict: stats by lane name::
+
+            {
+                lane name (string): {
+                    policy (string): overflow policy
+                    depth (int): number of queued messages
+                    maxsize (int): max number of messages
+                    drops (int): number of dropped messages
+                    coalesced (int): number of coalesced messages
+                },
+                ...
+            }
+
+        """
+        return {lane.name: lane.to_dict() for lane in self.__lanes}
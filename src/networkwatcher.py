@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import socket
+import gevent
+from gevent.socket import wait_read
+
+# netlink multicast groups (linux/rtnetlink.h)
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+
+class NetworkWatcher:
+    """
+    Watch network interfaces and trigger callback when they change
+
+    On Linux it listens to netlink route events (links and addresses) so it only wakes up
+    when something really changes. On other platforms it checks interfaces signature
+    periodically.
+    """
+
+    CHECK_INTERVAL = 5.0  # seconds
+    SETTLE_DELAY = 1.0  # seconds
+
+    def __init__(self, get_signature, on_change, debug_enabled):
+        """
+        Constructor
+
+        Args:
+            get_signature (callback): function returning interfaces signature (used when
+                                      netlink is not available)
+            on_change (callback): function called when network changed
+            debug_enabled (bool): True if debug is enabled
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if debug_enabled:
+            self.logger.setLevel(logging.DEBUG)
+        self.get_signature = get_signature
+        self.on_change = on_change
+        self.__greenlet = None
+        self.__netlink = None
+
+    def start(self):
+        """
+        Start watching network
+        """
+        if self.__greenlet:
+            return
+
+        self.__netlink = self.__open_netlink()
+        target = self.__watch_netlink if self.__netlink else self.__watch_signature
+        self.__greenlet = gevent.spawn(target)
+
+    def stop(self):
+        """
+        Stop watching network
+        """
+        if self.__greenlet:
+            self.__greenlet.kill()
+            self.__greenlet = None
+        if self.__netlink:
+            self.__netlink.close()
+            self.__netlink = None
+
+    def __open_netlink(self):
+        """
+        Open netlink route socket
+
+        Returns:
+            socket: netlink socket or None if not supported on this platform
+        """
+        try:
+            netlink = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE
+            )
+            netlink.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+            netlink.setblocking(False)
+            self.logger.debug("Watch network using netlink")
+            return netlink
+        except (AttributeError, OSError):
+            self.logger.debug("Netlink not available, watch network periodically")
+            return None
+
+    def __drain_netlink(self):
+        """
+        Read all pending netlink events
+        """
+        try:
+            while self.__netlink.recv(65536):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def __trigger_change(self):
+        """
+        Trigger network change callback
+        """
+        try:
+            self.on_change()
+        except Exception:
+            self.logger.exception("Error handling network change")
+
+    def __watch_netlink(self):
+        """
+        Wait for netlink events (blocking)
+        """
+        while True:
+            wait_read(self.__netlink.fileno())
+            # let interface settle and merge burst of events
+            gevent.sleep(self.SETTLE_DELAY)
+            self.__drain_netlink()
+            self.logger.debug("Network change detected by netlink")
+            self.__trigger_change()
+
+    def __watch_signature(self):
+        """
+        Check interfaces signature periodically (blocking)
+        """
+        signature = self.get_signature()
+        while True:
+            gevent.sleep(self.CHECK_INTERVAL)
+            new_signature = self.get_signature()
+            if new_signature != signature:
+                signature = new_signature
+                self.logger.debug("Network change detected by signature")
+                self.__trigger_change()
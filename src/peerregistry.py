@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from common import PeerInfos
+
+
+class PeerRegistry:
+    """
+    Peers registry
+
+    Peers are stored by bus ident with secondary indexes by Cleep uuid, mac address, hostname
+    and ip. A device reconnecting with a new ident replaces its previous entry (same uuid),
+    and offline peers are evicted after OFFLINE_TTL seconds.
+
+    Registry can be saved to and loaded from a json file to know devices at startup.
+    """
+
+    CACHE_VERSION = 1
+
+    OFFLINE_TTL = 24 * 60 * 60  # seconds
+
+    def __init__(self, offline_ttl=None):
+        """
+        Constructor
+
+        Args:
+            offline_ttl (float): time in seconds before evicting offline peer. Default OFFLINE_TTL
+        """
+        self.offline_ttl = offline_ttl or self.OFFLINE_TTL
+        # ident => PeerInfos
+        self.__peers = {}
+        # secondary indexes
+        self.__by_uuid = {}
+        self.__by_mac = {}
+        self.__by_ip = {}
+        self.__by_hostname = {}
+        # offline peers ident => offline since (monotonic), by offline order
+        self.__offline = OrderedDict()
+        self.__evicted = 0
+        self.__replaced = 0
+        # ident => last seen timestamp (wall clock, persisted)
+        self.__last_seen = {}
+
+    def __len__(self):
+        return len(self.__peers)
+
+    def __contains__(self, ident):
+        return ident in self.__peers
+
+    def __getitem__(self, ident):
+        return self.__peers[ident]
+
+    def __setitem__(self, ident, peer_infos):
+        self.add(ident, peer_infos)
+
+    def get(self, ident, default=None):
+        """
+        Return peer by ident
+
+        Args:
+            ident (string): peer ident
+            default (any): value returned if peer is unknown
+
+        Returns:
+            PeerInfos: peer infos
+        """
+        return self.__peers.get(ident, default)
+
+    def values(self):
+        """
+        Return registered peers
+
+        Returns:
+            list: list of PeerInfos
+        """
+        return list(self.__peers.values())
+
+    def add(self, ident, peer_infos):
+        """
+        Add or replace peer. Previous entry of the same device (same uuid) is removed. Peer infos
+        cached json is invalidated (fields may have been set before adding it)
+
+        Args:
+            ident (string): peer ident
+            peer_infos (PeerInfos): peer infos
+        """
+        previous_ident = self.__by_uuid.get(peer_infos.uuid) if peer_infos.uuid else None
+        if previous_ident is not None and previous_ident != ident:
+            self.remove(previous_ident)
+            self.__replaced += 1
+        self.remove(ident)
+
+        peer_infos.invalidate()
+        self.__peers[ident] = peer_infos
+        self.__last_seen[ident] = time.time()
+        if peer_infos.uuid:
+            self.__by_uuid[peer_infos.uuid] = ident
+        for mac in peer_infos.macs or []:
+            self.__by_mac[mac] = ident
+        if peer_infos.ip:
+            self.__by_ip[peer_infos.ip] = ident
+        if peer_infos.hostname:
+            self.__by_hostname.setdefault(peer_infos.hostname, set()).add(ident)
+        if not peer_infos.online:
+            self.__offline[ident] = time.monotonic()
+
+        self.evict()
+
+    def remove(self, ident):
+        """
+        Remove peer
+
+        Args:
+            ident (string): peer ident
+
+        Returns:
+            PeerInfos: removed peer or None if peer is unknown
+        """
+        peer_infos = self.__peers.pop(ident, None)
+        if peer_infos is None:
+            return None
+
+        self.__offline.pop(ident, None)
+        self.__last_seen.pop(ident, None)
+        if self.__by_uuid.get(peer_infos.uuid) == ident:
+            del self.__by_uuid[peer_infos.uuid]
+        for mac in peer_infos.macs or []:
+            if self.__by_mac.get(mac) == ident:
+                del self.__by_mac[mac]
+        if self.__by_ip.get(peer_infos.ip) == ident:
+            del self.__by_ip[peer_infos.ip]
+        idents = self.__by_hostname.get(peer_infos.hostname)
+        if idents:
+            idents.discard(ident)
+            if not idents:
+                del self.__by_hostname[peer_infos.hostname]
+
+        return peer_infos
+
+    def set_offline(self, ident):
+        """
+        Flag peer as offline. It will be evicted after offline ttl
+
+        Args:
+            ident (string): peer ident
+
+        Returns:
+            PeerInfos: peer infos or None if peer is unknown
+        """
+        peer_infos = self.__peers.get(ident)
+        if peer_infos:
+            peer_infos.set_online(False)
+            self.__offline[ident] = time.monotonic()
+            self.__offline.move_to_end(ident)
+            self.__last_seen[ident] = time.time()
+
+        self.evict()
+        return peer_infos
+
+    def evict(self):
+        """
+        Evict peers offline for more than offline ttl
+
+        Returns:
+            int: number of evicted peers
+        """
+        evicted = 0
+        deadline = time.monotonic() - self.offline_ttl
+        while self.__offline:
+            ident, offline_since = next(iter(self.__offline.items()))
+            if offline_since > deadline:
+                break
+            self.remove(ident)
+            evicted += 1
+
+        self.__evicted += evicted
+        return evicted
+
+    def save(self, path):
+        """
+        Save registry to json file. File is written atomically (temporary file renamed)
+
+        Args:
+            path (string): file path
+        """
+        now = time.time()
+        cache = {
+            "version": self.CACHE_VERSION,
+            "peers": [
+                {
+                    "lastseen": now if peer_infos.online else self.__last_seen[ident],
+                    "peer": peer_infos.to_dict(),
+                }
+                for ident, peer_infos in self.__peers.items()
+            ],
+        }
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fd:
+            json.dump(cache, fd, separators=(",", ":"))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """
+        Load registry from json file saved with save. Loaded peers are offline and flagged as
+        cached in their extra data (with their last seen timestamp), until they connect again.
+        Peers not seen for more than offline ttl are skipped.
+
+        Args:
+            path (string): file path
+
+        Returns:
+            int: number of loaded peers
+        """
+        with open(path, "r", encoding="utf-8") as fd:
+            cache = json.load(fd)
+        if cache.get("version") != self.CACHE_VERSION:
+            return 0
+
+        loaded = 0
+        now = time.time()
+        entries = sorted(cache.get("peers", []), key=lambda entry: entry.get("lastseen", 0))
+        for entry in entries:
+            last_seen = entry.get("lastseen", 0)
+            if now - last_seen > self.offline_ttl:
+                continue
+            peer_infos = PeerInfos()
+            peer_infos.fill_from_dict(entry.get("peer", {}), owned=True)
+            if not peer_infos.ident or peer_infos.uuid in self.__by_uuid:
+                continue
+            peer_infos.set_online(False)
+            peer_infos.update_extra({"cached": True, "lastseen": int(last_seen)})
+            self.add(peer_infos.ident, peer_infos)
+            # keep offline duration to evict peer at the right time
+            self.__offline[peer_infos.ident] = time.monotonic() - (now - last_seen)
+            self.__last_seen[peer_infos.ident] = last_seen
+            loaded += 1
+
+        return loaded
+
+    def find_by_uuid(self, uuid):
+        """
+        Return peer by Cleep uuid
+
+        Args:
+            uuid (string): device uuid
+
+        Returns:
+            PeerInfos: peer infos or None if not found
+        """
+        return self.__peers.get(self.__by_uuid.get(uuid))
+
+    def find_by_mac(self, mac):
+        """
+        Return peer by mac address
+
+        Args:
+            mac (string): mac address
+
+        Returns:
+            PeerInfos: peer infos or None if not found
+        """
+        return self.__peers.get(self.__by_mac.get(mac))
+
+    def find_by_ip(self, ip):
+        """
+        Return peer by ip
+
+        Args:
+            ip (string): ip address
+
+        Returns:
+            PeerInfos: peer infos or None if not found
+        """
+        return self.__peers.get(self.__by_ip.get(ip))
+
+    def find_by_hostname(self, hostname):
+        """
+        Return peers by hostname (several unconfigured devices can share the same hostname)
+
+        Args:
+            hostname (string): hostname
+
+        Returns:
+            list: list of PeerInfos
+        """
+        return [
+            self.__peers[ident] for ident in self.__by_hostname.get(hostname, ())
+        ]
+
+    def get_stats(self):
+        """
+        Return registry stats
+
+        Returns:
+            dict: registry stats::
+
+            {
+                size (int): number of peers
+                online (int): number of online peers
+                offline (int): number of offline peers
+                evicted (int): number of evicted offline peers
+                replaced (int): number of entries replaced by device reconnection
+                indexes (dict): number of entries by index
+                bytes (int): approximative registry memory size (containers and peers)
+            }
+
+        """
+        containers = [
+            self.__peers,
+            self.__by_uuid,
+            self.__by_mac,
+            self.__by_ip,
+            self.__by_hostname,
+            self.__offline,
+        ]
+        size = sum(sys.getsizeof(container) for container in containers)
+        for peer_infos in self.__peers.values():
+            size += sys.getsizeof(peer_infos) + sys.getsizeof(peer_infos.extra)
+
+        return {
+            "size": len(self.__peers),
+            "online": len(self.__peers) - len(self.__offline),
+            "offline": len(self.__offline),
+            "evicted": self.__evicted,
+            "replaced": self.__replaced,
+            "indexes": {
+                "uuid": len(self.__by_uuid),
+                "mac": len(self.__by_mac),
+                "ip": len(self.__by_ip),
+                "hostname": len(self.__by_hostname),
+            },
+            "bytes": size,
+        }
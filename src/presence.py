@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from collections import OrderedDict
+import gevent
+
+
+class PresenceDebouncer:
+    """
+    Coalesce flapping peer presence changes
+
+    First presence change of a peer is emitted immediately. Following changes occuring within
+    the window are held and merged into their net state change, emitted at the end of the
+    window (nothing is emitted if peer came back to its last emitted state, unless it
+    reconnected with another ident or ip). Peer state is dropped once its window elapsed
+    without held change.
+    """
+
+    WINDOW = 2.0  # seconds
+    MAX_PEERS_STATS = 256  # max number of peers in suppressed events stats
+
+    def __init__(self, emit, window=None):
+        """
+        Constructor
+
+        Args:
+            emit (function): function called to emit presence change. Function parameters::
+
+                                connected (bool): True if peer is connected
+                                peer_infos (PeerInfos): peer informations
+
+            window (float): coalescing window in seconds (0 to disable). Default WINDOW
+        """
+        self.emit = emit
+        self.window = self.WINDOW if window is None else window
+        # peer key => {online, address, emittedat, pending}
+        self.__states = {}
+        # peer key => number of suppressed events, by last suppression order
+        self.__suppressed = OrderedDict()
+        self.__suppressed_total = 0
+
+    def push(self, connected, peer_infos):
+        """
+        Push peer presence change
+
+        Args:
+            connected (bool): True if peer is connected
+            peer_infos (PeerInfos): peer informations
+        """
+        if not self.window:
+            self.emit(connected, peer_infos)
+            return
+
+        # peer ident changes after each connection, use device uuid
+        key = peer_infos.uuid or peer_infos.ident
+        state = self.__states.setdefault(
+            key, {"online": None, "address": None, "emittedat": None, "pending": None}
+        )
+        now = time.monotonic()
+
+        if state["pending"]:
+            # change already held, replace it
+            self.__suppress(key)
+            state["pending"] = (connected, peer_infos)
+            return
+
+        if state["emittedat"] is None or now - state["emittedat"] >= self.window:
+            self.__emit(key, state, connected, peer_infos)
+            return
+
+        # hold change until end of window
+        state["pending"] = (connected, peer_infos)
+        gevent.spawn_later(
+            state["emittedat"] + self.window - now, self.__flush, key
+        )
+
+    def __emit(self, key, state, connected, peer_infos):
+        """
+        Emit presence change
+
+        Args:
+            key (string): peer key
+            state (dict): peer state
+            connected (bool): True if peer is connected
+            peer_infos (PeerInfos): peer informations
+        """
+        state["online"] = connected
+        state["address"] = (peer_infos.ident, peer_infos.ip)
+        state["emittedat"] = time.monotonic()
+        gevent.spawn_later(self.window, self.__prune, key, state["emittedat"])
+        self.emit(connected, peer_infos)
+
+    def __prune(self, key, emitted_at):
+        """
+        Drop peer state at end of window if nothing was emitted since and no change is held
+
+        Args:
+            key (string): peer key
+            emitted_at (float): emission time of window
+        """
+        state = self.__states.get(key)
+        if state and not state["pending"] and state["emittedat"] == emitted_at:
+            del self.__states[key]
+
+    def __flush(self, key):
+        """
+        Emit held change of peer at end of window, if it changes last emitted state. A
+        connection is emitted again if peer reconnected with another ident or ip
+
+        Args:
+            key (string): peer key
+        """
+        state = self.__states.get(key)
+        if not state or not state["pending"]:
+            return
+
+        connected, peer_infos = state["pending"]
+        state["pending"] = None
+        address = (peer_infos.ident, peer_infos.ip)
+        if connected == state["online"] and (
+            not connected or address == state["address"]
+        ):
+            # peer came back to its last emitted state
+            self.__suppress(key)
+            self.__prune(key, state["emittedat"])
+            return
+        self.__emit(key, state, connected, peer_infos)
+
+    def __suppress(self, key):
+        """
+        Count suppressed event. Only MAX_PEERS_STATS last peers are kept in per peer stats
+
+        Args:
+            key (string): peer key
+        """
+        self.__suppressed_total += 1
+        self.__suppressed[key] = self.__suppressed.get(key, 0) + 1
+        self.__suppressed.move_to_end(key)
+        if len(self.__suppressed) > self.MAX_PEERS_STATS:
+            self.__suppressed.popitem(last=False)
+
+    def get_stats(self):
+        """
+        Return debouncer stats
+
+        Returns:
+            dict: debouncer stats::
+
+            {
+                window (float): coalescing window in seconds
+                pending (int): number of held changes
+                tracked (int): number of peers within their window
+                suppressed (int): total number of suppressed events
+                peers (dict): number of suppressed events by peer (device uuid) for last
+                              MAX_PEERS_STATS peers with suppressed events
+            }
+
+        """
+        return {
+            "window": self.window,
+            "pending": sum(1 for state in self.__states.values() if state["pending"]),
+            "tracked": len(self.__states),
+            "suppressed": self.__suppressed_total,
+            "peers": dict(self.__suppressed),
+        }
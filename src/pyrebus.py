@@ -8,6 +8,7 @@ import uuid
 import binascii
 import os
 import ipaddress
+from collections import deque
 from urllib.parse import urlparse
 import netifaces  # netifaces-plus from pyre-gevent package
 import netaddr
@@ -15,12 +16,15 @@ from pyre_gevent import Pyre
 from pyre_gevent.zhelper import get_ifaddrs as zhelper_get_ifaddrs, u
 import zmq.green as zmq
 from externalbus import ExternalBus
-from common import MessageRequest
-from gevent import sleep as gsleep
+from common import MessageRequest, WakeupsCounter, intern_string
+from codec import Codecs
+from gevent import sleep as gsleep, getcurrent
+from gevent.event import Event
 
 AF_INET = 2
 AF_INET6 = 10
 AF_PACKET = 17
+SYS_CLASS_NET = "/sys/class/net"
 
 
 class PyreBus(ExternalBus):
@@ -31,9 +35,22 @@ class PyreBus(ExternalBus):
     This code is based on chat example (https://github.com/zeromq/pyre/blob/master/examples/chat.py)
     """
 
-    BUS_STOP = "$$STOP$$"
+    PIPE_STOP = b"STOP"
+    PIPE_WHISPER = b"WHISPER"
+    PIPE_SHOUT = b"SHOUT"
+    PIPE_RESTART = b"RESTART"
+    PIPE_MULTICAST = b"MULTICAST"
+
+    WHISPER_CHANNEL = "WHISPER"
+
+    CODECS_HEADER = "codecs"
+    COMPRESSION_HEADER = "compression"
+    BATCH_HEADER = "batch"
 
     POLL_TIMEOUT = 500  # ms
+    POLL_BUDGET = 50  # max frames handled per run_once call
+    PIPE_BACKLOG_SIZE = 10000  # max messages waiting for pipe room
+    RUN_STOPPED = -1
 
     def __init__(
         self,
@@ -43,6 +60,7 @@ class PyreBus(ExternalBus):
         decode_peer_infos,
         debug_enabled,
         crash_report,
+        compression_threshold=None,
     ):
         """
         Constructor
@@ -53,6 +71,8 @@ class PyreBus(ExternalBus):
             on_peer_disconnected (callback): function called when peer is disconnected
             debug_enabled (bool): True if debug is enabled
             crash_report (CrashReport): crash report instance
+            compression_threshold (int): payload size above which payload is compressed.
+                                         Default Codecs.COMPRESSION_THRESHOLD
         """
         ExternalBus.__init__(
             self,
@@ -85,6 +105,8 @@ class PyreBus(ExternalBus):
         # members
         self.decode_peer_infos = decode_peer_infos
         self.__externalbus_configured = False
+        self.__configured_event = Event()
+        self.wakeups = WakeupsCounter()
         self.node = None
         self.node_socket = None
         self.context = None
@@ -92,10 +114,144 @@ class PyreBus(ExternalBus):
         self.pipe_in = None
         self.pipe_out = None
         self.__bus_name = None
-        self.__bus_channel = None
+        self.__bus_channels = []
+        # per channel stats: channel name => {messagesin, messagesout, bytesin, bytesout}
+        self.__channel_stats = {}
         self.endpoint = None
+        self.__restart_infos = None
+        self.__restart_requested_at = None
+        self.__reconnection_stats = {"count": 0, "last": None, "total": 0.0}
+        # mac addresses cache
+        self.__macs = None
+        self.__interfaces_signature = None
+        self.codecs = Codecs(compression_threshold)
+        # codecs advertised by peers: peer ident (string) => list of codec names
+        self.__peer_codecs = {}
+        # idents of peers supporting compression
+        self.__peer_compression = set()
+        # idents of peers supporting commands batch
+        self.__peer_batch = set()
+        # routing table to current peer ident: device uuid, mac or ident => (ident, ident bytes)
+        self.__routes = {}
+        # route keys by peer ident
+        self.__peer_routes = {}
+        # pipe stats to follow messages pushed to pipe and not sent on bus yet
+        self.__pipe_pushed = 0
+        self.__pipe_sent = 0
+        # frames waiting for pipe room (pipe is full), sent in order by bus loop
+        self.__pipe_backlog = deque()
+
+    def get_inflight_count(self):
+        """
+        Return number of messages pushed on pipe and not sent on bus yet
+
+        Returns:
+            int: number of in-flight messages
+        """
+        return self.__pipe_pushed - self.__pipe_sent
+
+    def get_pipe_stats(self):
+        """
+        Return pipe stats
+
+        Returns:
+            dict: pipe stats::
+
+            {
+                pushed (int): number of messages pushed on pipe
+                sent (int): number of messages sent on bus
+                inflight (int): number of messages pushed on pipe and not sent yet
+                backlog (int): number of messages waiting for pipe room
+            }
+
+        """
+        return {
+            "pushed": self.__pipe_pushed,
+            "sent": self.__pipe_sent,
+            "inflight": self.get_inflight_count(),
+            "backlog": len(self.__pipe_backlog),
+        }
+
+    def get_interfaces_signature(self):
+        """
+        Return cheap signature of network interfaces state used to detect interfaces changes.
+        It is based on /sys/class/net content on Linux (interface names, operstate and
+        address) and falls back to interface names on other platforms. Interfaces IPv4 and
+        IPv6 addresses are part of the signature on all platforms.
+
+        Returns:
+            tuple: interfaces signature
+        """
+        try:
+            signature = []
+            for name in sorted(os.listdir(SYS_CLASS_NET)):
+                state = [name]
+                for attribute in ("operstate", "address"):
+                    try:
+                        with open(
+                            os.path.join(SYS_CLASS_NET, name, attribute),
+                            encoding="utf-8",
+                        ) as fd:
+                            state.append(fd.read().strip())
+                    except OSError:
+                        state.append(None)
+                state.extend(PyreBus.get_interface_addresses(name))
+                signature.append(tuple(state))
+            return tuple(signature)
+        except OSError:
+            return tuple(
+                (name,) + PyreBus.get_interface_addresses(name)
+                for name in sorted(netifaces.interfaces())
+            )
+
+    @staticmethod
+    def get_interface_addresses(name):
+        """
+        Return IPv4 and IPv6 addresses of network interface
+
+        Args:
+            name (string): interface name
+
+        Returns:
+            tuple: sorted IPv4 addresses (tuple) and sorted IPv6 addresses (tuple)
+        """
+        try:
+            addresses = netifaces.ifaddresses(name)
+        except (ValueError, OSError):
+            # interface disappeared
+            return (), ()
+
+        return tuple(
+            tuple(
+                sorted(
+                    address.get("addr", "") for address in addresses.get(family, [])
+                )
+            )
+            for family in (netifaces.AF_INET, netifaces.AF_INET6)
+        )
 
-    def get_mac_addresses(self):
+    def get_mac_addresses(self, force=False):
+        """
+        Return list of mac addresses used to identify cleep device
+
+        Mac addresses are cached and interfaces are only scanned again when interfaces
+        signature (including interfaces addresses) changes.
+
+        Args:
+            force (bool): force interfaces scan
+
+        Returns:
+            list: list of mac addresses
+        """
+        signature = self.get_interfaces_signature()
+        if force or self.__macs is None or signature != self.__interfaces_signature:
+            self.logger.debug("Network interfaces changed, scan them")
+            self.__macs = self.scan_mac_addresses()
+            self.__interfaces_signature = signature
+
+        return list(self.__macs)
+
+    def scan_mac_addresses(self):
         """
         Use pyre zhelper to get list of mac addresses used to identify cleep device
         Code copied from pyre-gevent/zbeacon
@@ -232,10 +388,20 @@ class PyreBus(ExternalBus):
         # send stop message to unblock pyre task
         if self.pipe_in is not None:
             self.logger.debug("Send STOP on pipe")
-            self.pipe_in.send(json.dumps(self.BUS_STOP).encode("utf-8"))
+            try:
+                self.pipe_in.send_multipart([self.PIPE_STOP], zmq.NOBLOCK)
+            except zmq.Again:
+                self.logger.debug("Pipe is full, bus is closed without STOP")
             gsleep(0.15)
 
             # and close everything
+            self.__close()
+
+    def __close(self):
+        """
+        Close pipe and stop pyre node. Zmq context is kept to be reused
+        """
+        if self.pipe_in is not None:
             self.pipe_in.close()
             self.pipe_in = None
 
@@ -258,6 +424,94 @@ class PyreBus(ExternalBus):
             self.poller = None
 
             self.__externalbus_configured = False
+            self.__configured_event.clear()
+
+    def restart(self, infos):
+        """
+        Restart pyre node in place (zmq context is reused) with new peer infos
+
+        Restart is performed by bus loop to avoid closing sockets it is polling.
+
+        Args:
+            infos (dict): peer infos
+        """
+        self.__restart_infos = infos
+        self.__restart_requested_at = time.monotonic()
+        if self.pipe_in is None:
+            # bus not started yet
+            self.__restart_node()
+            return
+
+        self.logger.debug("Send RESTART on pipe")
+        self.__pipe_backlog.append([self.PIPE_RESTART])
+        self.__flush_pipe_backlog()
+
+    def __restart_node(self):
+        """
+        Close current pyre node and start new one
+
+        Old node does not receive EXIT of its peers: they are disconnected and their routes
+        are dropped, new node receives ENTER of reachable peers.
+        """
+        self.logger.info("Restart pyre node")
+        self.__close()
+        self.__disconnect_peers()
+        connected = self.start(
+            self.__restart_infos,
+            self.__bus_name or "CLEEP",
+            self.__bus_channels or "CLEEP",
+        )
+
+        duration = time.monotonic() - self.__restart_requested_at
+        self.__reconnection_stats["count"] += 1
+        self.__reconnection_stats["last"] = duration
+        self.__reconnection_stats["total"] += duration
+        self.logger.info(
+            "Pyre node restarted in %.3fs (%s)",
+            duration,
+            "connected" if connected else "localhost",
+        )
+
+    def __disconnect_peers(self):
+        """
+        Disconnect all peers known by node, clearing routing table and peers capabilities
+        """
+        peer_idents = list(self.__peer_codecs.keys())
+        self.__routes.clear()
+        self.__peer_routes.clear()
+        self.__peer_codecs.clear()
+        self.__peer_compression.clear()
+        self.__peer_batch.clear()
+        for peer_ident in peer_idents:
+            try:
+                self.on_peer_disconnected(peer_ident)
+            except Exception:
+                self.logger.exception("Error handling peer disconnection")
+
+    def get_reconnection_stats(self):
+        """
+        Return pyre node restarts stats
+
+        Returns:
+            dict: reconnection stats::
+
+            {
+                count (int): number of restarts
+                last (float): last restart duration in seconds
+                total (float): total restarts duration in seconds
+            }
+
+        """
+        return dict(self.__reconnection_stats)
+
+    def is_on_localhost(self):
+        """
+        Return True if pyre node endpoint is bound to localhost (no usable network)
+
+        Returns:
+            bool: True if node is bound to localhost
+        """
+        return not self.endpoint or self.endpoint.find("127.0.0.1") != -1
 
     def start(self, infos, bus_name="CLEEP", bus_channel="CLEEP"):
         """
@@ -266,7 +520,8 @@ class PyreBus(ExternalBus):
         Args:
             infos (dict): peer infos
             bus_name (string): bus name to create. Default CLEEP
-            bus_channel (string): bus channel to join. Default CLEEP
+            bus_channel (string|list): bus channel or list of bus channels to join. First one is
+                                       the default channel. Default CLEEP
 
         Returns:
             bool: True if successfully connected to pyrebus, False otherwise (connected to localhost)
@@ -276,12 +531,19 @@ class PyreBus(ExternalBus):
             raise Exception('Parameter "infos" is not specified or invalid')
         if not bus_name or not isinstance(bus_name, str):
             raise Exception('Parameter "bus_name" is not specified or invalid')
-        if not bus_channel or not isinstance(bus_channel, str):
+        bus_channels = [bus_channel] if isinstance(bus_channel, str) else bus_channel
+        if (
+            not bus_channels
+            or not isinstance(bus_channels, list)
+            or not all(channel and isinstance(channel, str) for channel in bus_channels)
+        ):
             raise Exception('Parameter "bus_channel" is not specified or invalid')
 
         # save members
         self.__bus_name = bus_name
-        self.__bus_channel = bus_channel
+        self.__bus_channels = list(bus_channels)
+        for channel in self.__bus_channels:
+            self.__channel_stats.setdefault(channel, self.__new_channel_stats())
 
         # zmq context
         if self.context is None:
@@ -310,7 +572,8 @@ class PyreBus(ExternalBus):
         self.node = Pyre(self.__bus_name)
         for key, value in infos.items():
             self.node.set_header(key, value)
-        self.node.join(self.__bus_channel)
+        for channel in self.__bus_channels:
+            self.node.join(channel)
         self.node.start()
 
         # communication socket
@@ -322,11 +585,67 @@ class PyreBus(ExternalBus):
         self.poller.register(self.node_socket, zmq.POLLIN)
 
         self.__externalbus_configured = True
+        self.__configured_event.set()
 
         # check endpoint
         self.endpoint = self.node.endpoint()
         self.logger.info('Connected to cleepbus endpoint "%s"', self.endpoint)
-        return self.endpoint.find("127.0.0.1") == -1
+        return not self.is_on_localhost()
+
+    @staticmethod
+    def __new_channel_stats():
+        """
+        Return new channel stats
+
+        Returns:
+            dict: channel stats
+        """
+        return {"messagesin": 0, "messagesout": 0, "bytesin": 0, "bytesout": 0}
+
+    def __update_channel_stats(self, channel, direction, size):
+        """
+        Update channel stats
+
+        Args:
+            channel (string): channel name (WHISPER_CHANNEL for whispers)
+            direction (string): "in" or "out"
+            size (int): message size in bytes
+        """
+        stats = self.__channel_stats.setdefault(channel, self.__new_channel_stats())
+        stats[f"messages{direction}"] += 1
+        stats[f"bytes{direction}"] += size
+
+    def get_channels(self):
+        """
+        Return joined channels
+
+        Returns:
+            list: list of channel names, default channel first
+        """
+        return list(self.__bus_channels)
+
+    def get_channel_stats(self):
+        """
+        Return messages and bytes counters by channel. Whispers (not bound to channel) are
+        counted under WHISPER_CHANNEL
+
+        Returns:
+            dict: stats by channel::
+
+            {
+                channel (string): {
+                    messagesin (int): number of received messages
+                    messagesout (int): number of sent messages
+                    bytesin (int): number of received bytes
+                    bytesout (int): number of sent bytes
+                },
+                ...
+            }
+
+        """
+        return {
+            channel: dict(stats) for channel, stats in self.__channel_stats.items()
+        }
 
     def is_running(self):
         """
@@ -337,41 +656,87 @@ class PyreBus(ExternalBus):
         """
         return self.__externalbus_configured
 
-    def run_once(self):
+    def _run_once(self, budget, blocking):
         """
         Run pyre polling bus once
 
+        Once poller signals readable sockets, both pipe and node sockets are drained with
+        non-blocking reads until they are empty or frames budget is reached. Pending commands
+        that reached their timeout are expired after that.
+
+        Args:
+            budget (int): max number of frames to handle. Default POLL_BUDGET
+            blocking (bool): wait for sockets readiness without timeout instead of POLL_TIMEOUT.
+                             Poll still wakes up to expire pending commands
+
         Returns:
-            bool: return True all the time except when bus is stopped or not configured
-                  This is only useful when run_once is called by 'run' function
+            int: number of handled frames or RUN_STOPPED if bus is stopped.
+                 This is only useful when run_once is called by 'run' function
         """
         # check configuration
         if not self.__externalbus_configured:
             self.logger.debug(
                 "External bus is not configured yet, maybe no netword connection"
             )
-            return False
+            return 0
 
         # poll external bus
         items = {}
+        timeout = None if blocking else self.POLL_TIMEOUT
+        expiry_timeout = self.get_commands_expiry_timeout()
+        if expiry_timeout is not None:
+            # wake up to expire pending commands
+            expiry_timeout *= 1000
+            timeout = expiry_timeout if timeout is None else min(timeout, expiry_timeout)
         try:
-            items = dict(self.poller.poll(self.POLL_TIMEOUT))
+            items = dict(self.poller.poll(timeout))
+            self.wakeups.hit()
         except KeyboardInterrupt:
             # stop requested by user
             self.logger.debug("Stop Pyre bus")
             self.node.stop()
-            return False
+            return self.RUN_STOPPED
         except Exception:
             self.logger.exception("Exception occured during externalbus polling:")
 
         # process received data
-        if self.pipe_out in items and items[self.pipe_out] == zmq.POLLIN:
-            return self._message_to_send_to_pipe()
-        if self.node_socket in items and items[self.node_socket] == zmq.POLLIN:
-            return self._message_to_receive_from_pipe()
+        budget = budget or self.POLL_BUDGET
+        handled = 0
+        pipe_ready = items.get(self.pipe_out) == zmq.POLLIN
+        node_ready = items.get(self.node_socket) == zmq.POLLIN
+        while handled < budget and (pipe_ready or node_ready):
+            if pipe_ready:
+                handled += 1
+                if not self._message_to_send_to_pipe():
+                    return self.RUN_STOPPED
+                pipe_ready = PyreBus.has_pending_frame(self.pipe_out)
+                # node socket may have changed if node was restarted
+                node_ready = node_ready and PyreBus.has_pending_frame(
+                    self.node_socket
+                )
+            if node_ready and handled < budget:
+                handled += 1
+                self._message_to_receive_from_pipe()
+                node_ready = PyreBus.has_pending_frame(self.node_socket)
 
-        # timeout
-        return True
+        # pipe was drained, send messages waiting for pipe room
+        self.__flush_pipe_backlog()
+        self.expire_pending_commands()
+
+        return handled
+
+    @staticmethod
+    def has_pending_frame(socket):
+        """
+        Check without blocking if socket has frame to read
+
+        Args:
+            socket (zmq.Socket): socket to check
+
+        Returns:
+            bool: True if frame can be read without blocking
+        """
+        return bool(socket.getsockopt(zmq.EVENTS) & zmq.POLLIN)
 
     def _message_to_receive_from_pipe(self):
         """
@@ -383,6 +748,7 @@ class PyreBus(ExternalBus):
         data = self.node.recv()
         data_type = data.pop(0).decode("utf-8")
         data_peer = uuid.UUID(bytes=data.pop(0))
+        peer_ident = intern_string(str(data_peer))
         data_name = data.pop(0).decode("utf-8")
         self.logger.debug("type=%s peer=%s name=%s", data_type, data_peer, data_name)
 
@@ -400,24 +766,30 @@ class PyreBus(ExternalBus):
                 data_group = data.pop(0).decode("utf-8")
 
                 # check message group
-                if data_group != self.__bus_channel:
+                if data_group not in self.__bus_channels:
                     # invalid group
                     self.logger.debug(
-                        'Message received from another channel "%s" (current "%s")',
+                        'Message received from another channel "%s" (joined %s)',
                         data_group,
-                        self.__bus_channel,
+                        self.__bus_channels,
                     )
                     return True
+            else:
+                data_group = None
 
             # trigger message received callback
             try:
-                data_content = data.pop(0).decode("utf-8")
+                data_content = data.pop(0)
                 self.logger.debug("Raw data received on bus: %s", data_content)
-                raw_message = json.loads(data_content)
+                self.__update_channel_stats(
+                    data_group or self.WHISPER_CHANNEL, "in", len(data_content)
+                )
+                raw_message = self.codecs.decode(data_content)
                 message = MessageRequest()
-                message.fill_from_dict(raw_message)
+                message.fill_from_dict(raw_message, owned=True)
+                message.channel = data_group
                 self.logger.debug("Message request received: %s", str(message))
-                self.on_message_received(str(data_peer), message)
+                self.on_message_received(peer_ident, message)
             except Exception:
                 self.logger.exception("Error parsing peer message:")
 
@@ -425,6 +797,11 @@ class PyreBus(ExternalBus):
             # get message data
             infos = json.loads(data.pop(0).decode("utf-8"))
             self.logger.debug("Infos=%s", infos)
+            self.__peer_codecs[peer_ident] = self.__decode_codecs_header(infos)
+            if infos.get(self.COMPRESSION_HEADER) == self.codecs.COMPRESSION:
+                self.__peer_compression.add(peer_ident)
+            if infos.get(self.BATCH_HEADER) == "1":
+                self.__peer_batch.add(peer_ident)
             # get peer endpoint
             self.logger.debug("Peer endpoint: %s", self.node.peer_address(data_peer))
             peer_endpoint = urlparse(self.node.peer_address(data_peer))
@@ -435,95 +812,226 @@ class PyreBus(ExternalBus):
                 peer_infos = self.decode_peer_infos(infos)
                 self.logger.debug("Peer infos: %s", str(peer_infos))
                 # add extras to peer infos
-                peer_infos.ident = str(data_peer)
+                peer_infos.ident = peer_ident
                 peer_infos.ip = peer_endpoint.hostname
+                self.__add_routes(peer_infos, data_peer.bytes)
                 # save peer and trigger callback
-                self.on_peer_connected(str(data_peer), peer_infos)
+                self.on_peer_connected(peer_ident, peer_infos)
             except Exception:
                 self.logger.exception("Error handling new peer connection")
 
         elif data_type == "EXIT":
             # peer disconnected
+            self.__peer_codecs.pop(peer_ident, None)
+            self.__peer_compression.discard(peer_ident)
+            self.__peer_batch.discard(peer_ident)
+            self.__remove_routes(peer_ident)
             try:
-                self.on_peer_disconnected(str(data_peer))
+                self.on_peer_disconnected(peer_ident)
             except Exception:
                 self.logger.exception("Error handling peer disconnection")
 
         return True
 
-    @staticmethod
-    def clean_message(message):
+    def __decode_codecs_header(self, infos):
+        """
+        Decode codecs advertised by peer in its headers
+
+        Args:
+            infos (dict): peer headers
+
+        Returns:
+            list: list of codec names or None if peer does not advertise codecs
+        """
+        try:
+            codecs = json.loads(infos.get(self.CODECS_HEADER, "null"))
+            return codecs if isinstance(codecs, list) else None
+        except Exception:
+            self.logger.debug(
+                "Invalid codecs header: %s", infos.get(self.CODECS_HEADER)
+            )
+            return None
+
+    def get_peer_codec(self, peer_ident):
+        """
+        Return best codec supported by both sides
+
+        Args:
+            peer_ident (string): peer identifier
+
+        Returns:
+            Codec: codec to use with peer
+        """
+        return self.codecs.select(self.__peer_codecs.get(peer_ident))
+
+    def _is_batch_supported(self, peer_ident):
         """
-        Clean message removing useless field for external messaging
+        Return True if peer advertised commands batch support in its headers
 
         Args:
-            message (MessageRequest): message request instance
+            peer_ident (string): peer identifier, device uuid or mac address
 
         Returns:
-            dict: cleaned message request
+            bool: True if peer supports commands batch
+        """
+        peer_ident, _ = self.resolve_peer(peer_ident)
+        return peer_ident in self.__peer_batch
+
+    def __add_routes(self, peer_infos, peer_bytes):
         """
-        message_dict = message.to_dict()
-        message_dict.pop("startup", None)
-        message_dict.pop("broadcast", None)
-        message_dict.pop("peer_infos", None)
+        Route peer device uuid and mac addresses to its current ident
 
-        return message_dict
+        Args:
+            peer_infos (PeerInfos): connected peer infos
+            peer_bytes (bytes): peer ident bytes
+        """
+        ident = peer_infos.ident
+        self.__remove_routes(ident)
+        keys = [ident] + ([peer_infos.uuid] if peer_infos.uuid else [])
+        keys.extend(peer_infos.macs or [])
+        route = (ident, peer_bytes)
+        for key in keys:
+            self.__routes[key] = route
+        self.__peer_routes[ident] = keys
+
+    def __remove_routes(self, ident):
+        """
+        Remove routes to specified peer ident (routes updated by newer connection are kept)
+
+        Args:
+            ident (string): peer ident
+        """
+        for key in self.__peer_routes.pop(ident, []):
+            if self.__routes.get(key, (None,))[0] == ident:
+                del self.__routes[key]
+
+    def resolve_peer(self, peer):
+        """
+        Resolve current peer ident from device uuid, mac address or peer ident
+
+        Args:
+            peer (string): device uuid, mac address or peer ident
+
+        Returns:
+            tuple: peer ident (string) and peer ident bytes, (None, None) if peer cannot be resolved
+        """
+        route = self.__routes.get(peer)
+        if route:
+            return route
+
+        # unknown peer, try to use it as pyre ident
+        try:
+            return peer, uuid.UUID(peer).bytes
+        except (ValueError, TypeError, AttributeError):
+            return None, None
+
+    def __resolve_message_peer(self, peer_infos):
+        """
+        Resolve current peer ident of message recipient, by device uuid first, then by mac
+        addresses and finally by ident
+
+        Args:
+            peer_infos (PeerInfos): message peer infos
+
+        Returns:
+            tuple: peer ident (string) and peer ident bytes, (None, None) if peer cannot be resolved
+        """
+        for key in [peer_infos.uuid] + list(peer_infos.macs or []):
+            route = self.__routes.get(key)
+            if route:
+                return route
+
+        return self.resolve_peer(peer_infos.ident)
+
+    def get_routes_count(self):
+        """
+        Return number of entries in routing table
+
+        Returns:
+            int: number of routes
+        """
+        return len(self.__routes)
 
     def _message_to_send_to_pipe(self):
         """
         Send message to outside
 
+        Pipe frames are already serialized and cleaned by _send_message::
+
+            [PIPE_WHISPER, peer ident bytes, payload]
+            [PIPE_SHOUT, channel, payload]
+            [PIPE_MULTICAST, payload, peer ident bytes, peer ident bytes, ...]
+            [PIPE_STOP]
+            [PIPE_RESTART]
+
         Returns:
             bool: True to continue, False to stop external bus
         """
         # message to send
         try:
-            data = self.pipe_out.recv()
-            self.logger.debug("Raw data received on pipe: %s", data)
-            raw_message = json.loads(data.decode("utf-8"))
+            frames = self.pipe_out.recv_multipart()
+            self.logger.debug("Raw data received on pipe: %s", frames)
+            action = frames[0]
         except Exception:
             self.logger.exception("Error handling message to send")
             return True
 
         # stop node
-        if raw_message == self.BUS_STOP:
+        if action == self.PIPE_STOP:
             self.logger.debug("Stop Pyre bus")
             self.node.stop()
             return False
 
+        # restart node
+        if action == self.PIPE_RESTART:
+            self.__restart_node()
+            return True
+
         # send message
-        message = MessageRequest()
-        message.fill_from_dict(raw_message)
-        self.logger.debug("Send message: %s", message)
-        cleaned_message = PyreBus.clean_message(message)
-        if message.peer_infos and message.peer_infos.ident:
+        self.__pipe_sent += 1
+        if action == self.PIPE_WHISPER:
             # whisper message (to peer)
-            self.logger.debug("Whisper message: %s", cleaned_message)
-            self.node.whisper(
-                uuid.UUID(message.peer_infos.ident),
-                json.dumps(cleaned_message).encode("utf-8"),
+            self.logger.debug("Whisper message: %s", frames[2])
+            self.node.whisper(uuid.UUID(bytes=frames[1]), frames[2])
+            self.__update_channel_stats(self.WHISPER_CHANNEL, "out", len(frames[2]))
+        elif action == self.PIPE_MULTICAST:
+            # whisper same payload to several peers
+            payload = frames[1]
+            self.logger.debug(
+                "Multicast message to %d peers: %s", len(frames) - 2, payload
             )
+            for peer in frames[2:]:
+                self.node.whisper(uuid.UUID(bytes=peer), payload)
+                self.__update_channel_stats(self.WHISPER_CHANNEL, "out", len(payload))
         else:
             # shout message (broadcast)
-            self.logger.debug("Shout message: %s", cleaned_message)
-            self.node.shout(
-                self.__bus_channel, json.dumps(cleaned_message).encode("utf-8")
-            )
+            channel = frames[1].decode("utf-8")
+            self.logger.debug("Shout message on %s: %s", channel, frames[2])
+            self.node.shout(channel, frames[2])
+            self.__update_channel_stats(channel, "out", len(frames[2]))
 
         return True
 
-    def run(self):
+    def run(self, blocking=False):
         """
         Run pyre bus in infinite loop (blocking)
+
+        Args:
+            blocking (bool): idle mode, wait for bus configuration and sockets readiness
+                             without any periodic timeout
         """
         self.logger.debug("Pyre node started")
+        self._loop_greenlet = getcurrent()
         while True:
             try:
                 if not self.__externalbus_configured:
-                    # bus not configured (no network yet?), pause
-                    gsleep(0.25)
+                    # bus not configured (no network yet?), wait for it
+                    if blocking:
+                        self.__configured_event.wait()
+                    else:
+                        self.__configured_event.wait(0.25)
 
-                elif not self.run_once():
+                elif self.run_once(blocking=blocking) == self.RUN_STOPPED:
                     # stop requested
                     self.logger.debug("Stop requested programmatically")
                     break
@@ -535,7 +1043,10 @@ class PyreBus(ExternalBus):
 
             except Exception:
                 self.logger.exception("Exception during external bus process:")
+                # do not spin on persistent error
+                gsleep(self.POLL_TIMEOUT / 1000)
 
+        self._loop_greenlet = None
         self.logger.debug("Pyre node terminated")
 
     def _broadcast_message(self, message):
@@ -564,5 +1075,113 @@ class PyreBus(ExternalBus):
             )
             return
 
-        # send message
-        self.pipe_in.send(json.dumps(message.to_dict()).encode("utf-8"))
+        # serialize message only once, pipe carries final bus payload
+        cleaned_message = PyreBus.clean_message(message)
+        if message.peer_infos and (message.peer_infos.ident or message.peer_infos.uuid):
+            # whisper with best codec supported by peer, peer is routed by device uuid
+            peer_ident, peer = self.__resolve_message_peer(message.peer_infos)
+            if not peer:
+                self.logger.warning(
+                    "Unknown peer %s, message not sent", message.peer_infos.to_dict()
+                )
+                return
+            payload = self.__encode_for_peer(cleaned_message, peer_ident)
+            frames = [self.PIPE_WHISPER, peer, payload]
+        else:
+            # shout with default codec understood by all peers, on message channel if joined
+            channel = message.channel
+            if channel not in self.__bus_channels:
+                channel = self.__bus_channels[0]
+            payload = self.codecs.default.encode(cleaned_message)
+            frames = [self.PIPE_SHOUT, channel.encode("utf-8"), payload]
+
+        self.__push_frames(frames, message)
+
+    def _multicast_message(self, message, peer_idents):
+        """
+        Send same message to several peers
+
+        Message is serialized once for all peers sharing the same codec and compression
+        support, and the same payload is whispered to each of them.
+
+        Args:
+            message (MessageRequest): message to send
+            peer_idents (list): list of peer identifiers, device uuids or mac addresses
+        """
+        # check bus
+        if not self.__externalbus_configured:
+            self.logger.warning(
+                "External bus is not configured yet, maybe no network connection, message not sent: %s",
+                message.to_dict(),
+            )
+            return
+
+        # group peers by encoding
+        groups = {}
+        for recipient in peer_idents:
+            peer_ident, peer = self.resolve_peer(recipient)
+            if not peer:
+                self.logger.warning("Unknown peer %s, message not sent to it", recipient)
+                continue
+            encoding = (
+                self.get_peer_codec(peer_ident),
+                peer_ident in self.__peer_compression,
+            )
+            groups.setdefault(encoding, []).append(peer)
+
+        cleaned_message = PyreBus.clean_message(message)
+        for (codec, compress), peers in groups.items():
+            payload = codec.encode(cleaned_message)
+            if compress:
+                payload = self.codecs.compress(payload)
+            self.__push_frames([self.PIPE_MULTICAST, payload] + peers, message)
+
+    def __encode_for_peer(self, cleaned_message, peer_ident):
+        """
+        Encode message with best codec supported by peer, compressing it if supported
+
+        Args:
+            cleaned_message (dict): cleaned message
+            peer_ident (string): peer identifier
+
+        Returns:
+            bytes: payload
+        """
+        payload = self.get_peer_codec(peer_ident).encode(cleaned_message)
+        if peer_ident in self.__peer_compression:
+            payload = self.codecs.compress(payload)
+        return payload
+
+    def __push_frames(self, frames, message):
+        """
+        Push frames on pipe without waiting for it to be sent on bus
+
+        Pipe is written without blocking (zmq.green ignores SNDTIMEO): frames are kept in pipe
+        backlog while pipe is full and bus loop sends them once it drained the pipe.
+
+        Args:
+            frames (list): pipe frames
+            message (MessageRequest): sent message (for logging)
+        """
+        if len(self.__pipe_backlog) >= self.PIPE_BACKLOG_SIZE:
+            self.logger.warning(
+                "Pipe is full (%d messages in flight), message not sent: %s",
+                self.get_inflight_count(),
+                message.to_dict(),
+            )
+            return
+
+        self.__pipe_pushed += 1
+        self.__pipe_backlog.append(frames)
+        self.__flush_pipe_backlog()
+
+    def __flush_pipe_backlog(self):
+        """
+        Send pipe backlog frames, in order and without blocking, until pipe is full
+        """
+        while self.__pipe_backlog and self.pipe_in is not None:
+            try:
+                self.pipe_in.send_multipart(self.__pipe_backlog[0], zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            self.__pipe_backlog.popleft()
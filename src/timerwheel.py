@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel to expire keys at their timeout
+
+    Time is split in ticks of RESOLUTION seconds and each key is stored in the slot of its
+    deadline tick (modulo number of slots). Keys whose deadline is more than one wheel turn
+    away stay in their slot until their deadline tick is reached.
+
+    Adding and removing a key is O(1). Expiring keys only visits slots of elapsed ticks.
+    """
+
+    RESOLUTION = 0.1  # seconds
+    SLOTS = 512
+
+    def __init__(self, resolution=None, slots=None):
+        """
+        Constructor
+
+        Args:
+            resolution (float): tick duration in seconds. Default RESOLUTION
+            slots (int): number of slots in wheel. Default SLOTS
+        """
+        self.resolution = resolution or self.RESOLUTION
+        self.__slots = [{} for _ in range(slots or self.SLOTS)]
+        # key => slot index
+        self.__index = {}
+        self.__current_tick = self.__get_tick(time.monotonic())
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __contains__(self, key):
+        return key in self.__index
+
+    def __get_tick(self, now):
+        """
+        Return tick of specified time
+
+        Args:
+            now (float): monotonic time
+
+        Returns:
+            int: tick
+        """
+        return int(now / self.resolution)
+
+    def add(self, key, timeout):
+        """
+        Add key to wheel, replacing existing one
+
+        Args:
+            key (any): hashable key
+            timeout (float): timeout in seconds
+        """
+        self.remove(key)
+        # round deadline up to not expire key before its timeout
+        deadline_tick = self.__get_tick(time.monotonic() + max(timeout, 0.0)) + 1
+        slot_index = deadline_tick % len(self.__slots)
+        self.__slots[slot_index][key] = deadline_tick
+        self.__index[key] = slot_index
+
+    def remove(self, key):
+        """
+        Remove key from wheel
+
+        Args:
+            key (any): key to remove
+
+        Returns:
+            bool: True if key was in wheel
+        """
+        slot_index = self.__index.pop(key, None)
+        if slot_index is None:
+            return False
+        del self.__slots[slot_index][key]
+        return True
+
+    def expire(self):
+        """
+        Advance wheel to current time and return expired keys
+
+        Returns:
+            list: list of expired keys
+        """
+        now_tick = self.__get_tick(time.monotonic())
+        expired = []
+        if now_tick <= self.__current_tick:
+            return expired
+
+        # visit each slot at most once even if wheel was not advanced for a long time
+        ticks = min(now_tick - self.__current_tick, len(self.__slots))
+        for tick in range(now_tick - ticks + 1, now_tick + 1):
+            slot = self.__slots[tick % len(self.__slots)]
+            if not slot:
+                continue
+            for key in [key for key, deadline in slot.items() if deadline <= now_tick]:
+                del slot[key]
+                del self.__index[key]
+                expired.append(key)
+        self.__current_tick = now_tick
+
+        return expired
+
+    def get_next_timeout(self):
+        """
+        Return time before next tick, the max time callers can wait before calling expire
+
+        Returns:
+            float: timeout in seconds or None if wheel is empty
+        """
+        if not self.__index:
+            return None
+        return max(
+            (self.__current_tick + 1) * self.resolution - time.monotonic(),
+            0.0,
+        )